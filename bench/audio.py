@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+# Voice sessions: one AudioPlayer thread per session vs. the shared-tick audio engine
+#
+#   python3 bench/audio.py [-s SESSIONS ...] [-d SECONDS] [-t THREADS] [-f FILE] [--sources file|stalling ...]
+#
+# Every session reads Ogg/Opus packets from a local file, like FFmpegOpusAudio
+# reads them from FFmpeg, and sends them as RTP packets over UDP to localhost.
+# Packets aren't encrypted, PyNaCl isn't needed. Without FILE a file of
+# silent-sized frames is generated. With stalling sources a share of the
+# sessions blocks in read() like FFmpeg does, once while starting and once
+# mid-song. Jitter is how far the time between two packets of a session is off
+# 20 ms, a gap is a packet more than a frame late. Healthy gaps only count the
+# sessions that never stall.
+import argparse
+import asyncio
+import os
+import random
+import resource
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import discord
+from discord.oggparse import OggStream
+from discord.player import AudioPlayer
+from utils.audioengine import DELAY, AudioEngine
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-s', '--sessions', action='extend', nargs='*', type=int, help='Concurrent sessions per run. Defaults to 10 100 500')
+parser.add_argument('-d', '--duration', default=10.0, type=float, help='Seconds per run. Defaults to 10')
+parser.add_argument('-t', '--threads', default=1, type=int, help='Audio engine threads. Defaults to 1')
+parser.add_argument('-f', '--file', default=None, help='Ogg/Opus file to play. Defaults to a generated one')
+parser.add_argument('--sources', action='extend', nargs='*', choices=('file', 'stalling'), help='Source kinds to run. Defaults to both')
+parser.add_argument('--stalling', default=0.1, type=float, help='Share of stalling sessions with stalling sources. Defaults to 0.1')
+parser.add_argument('--stall', default=1.0, type=float, help='Seconds a stalling source blocks. Defaults to 1')
+args = parser.parse_args()
+
+
+def write_ogg(path, frames, size=160):
+    """Write an Ogg stream of `frames` packets of `size` bytes"""
+    with open(path, 'wb') as file:
+        for page, first in enumerate(range(0, frames, 50)):
+            packets = min(50, frames - first)
+            header = struct.pack('<4sBBQIIIB', b'OggS', 0, 0, (first + packets) * 960, 1, page, 0, packets)
+            file.write(header + bytes([size]) * packets + os.urandom(size) * packets)
+
+
+class FileSource(discord.AudioSource):
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.packets = OggStream(self.file).iter_packets()
+
+    def read(self):
+        return next(self.packets, b'')
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self.file.close()
+
+
+class StallingSource(FileSource):
+    """Blocks in read() while starting and once mid-song, like a slow FFmpeg"""
+    def __init__(self, path, stall_at):
+        super().__init__(path)
+        self.read_frames = 0
+        self.stall_at = stall_at
+
+    def read(self):
+        if self.read_frames in (0, self.stall_at):
+            time.sleep(args.stall)
+        self.read_frames += 1
+        return super().read()
+
+
+class FakeWebSocket:
+    async def speak(self, state=True):
+        pass
+
+
+class FakeVoiceClient:
+    """What AudioPlayer and the audio engine use of a VoiceClient"""
+    def __init__(self, loop, address):
+        self.loop = loop
+        self.ws = FakeWebSocket()
+        self.encoder = None
+        self._player = None
+        self._connected = threading.Event()
+        self._connected.set()
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.address = address
+        self.sequence = 0
+        self.timestamp = 0
+        self.sent = []
+
+    def is_connected(self):
+        return True
+
+    def is_playing(self):
+        return self._player is not None and self._player.is_playing()
+
+    def send_audio_packet(self, data, *, encode=True):
+        self.sequence = (self.sequence + 1) % 65536
+        header = struct.pack('>BBHII', 0x80, 0x78, self.sequence, self.timestamp, 1)
+        try:
+            self.socket.sendto(header + data, self.address)
+        except BlockingIOError:
+            pass
+        self.timestamp = (self.timestamp + 960) % 4294967296
+        self.sent.append(time.perf_counter())
+
+
+def jitter(clients):
+    late = []
+    for client in clients:
+        late += [abs(sent - previous - DELAY) for previous, sent in zip(client.sent, client.sent[1:])]
+    late.sort()
+    return late
+
+def run(mode, kind, sessions, path, loop, address):
+    clients = [FakeVoiceClient(loop, address) for _ in range(sessions)]
+    engine = AudioEngine(args.threads) if mode == 'engine' else None
+    rng = random.Random(0)
+    stalling = set(rng.sample(range(sessions), max(1, int(sessions * args.stalling)))) if kind == 'stalling' else set()
+    frames = int(args.duration / DELAY)
+    sources = [StallingSource(path, rng.randrange(frames // 4, frames // 2)) if i in stalling else FileSource(path) for i in range(sessions)]
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = time.process_time()
+    started = time.perf_counter()
+    for client, source in zip(clients, sources):
+        if engine:
+            engine.play(client, source)
+        else:
+            client._player = AudioPlayer(source, client)
+            client._player.start()
+    threads = threading.active_count()
+    time.sleep(args.duration)
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu
+    after = resource.getrusage(resource.RUSAGE_SELF)
+
+    for client in clients:
+        client._player.stop()
+    if engine:
+        engine.close()
+    else:
+        for client in clients:
+            client._player.join()
+    for client in clients:
+        client.socket.close()
+
+    late = jitter(clients)
+    healthy = jitter([client for i, client in enumerate(clients) if i not in stalling])
+    switches = after.ru_nvcsw + after.ru_nivcsw - usage.ru_nvcsw - usage.ru_nivcsw
+    return {
+        'threads': threads,
+        'cpu %': cpu / elapsed * 100,
+        'ctx sw/s': switches / elapsed,
+        'frames/s': sum(len(client.sent) for client in clients) / elapsed,
+        'p50 ms': late[len(late) // 2] * 1000,
+        'p99 ms': late[int(len(late) * 0.99)] * 1000,
+        'max ms': late[-1] * 1000,
+        'gaps %': sum(1 for seconds in late if seconds > DELAY) / len(late) * 100,
+        'healthy gaps %': sum(1 for seconds in healthy if seconds > DELAY) / len(healthy) * 100,
+    }
+
+def main():
+    # speaking updates go to an event loop, like they would to the gateway
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(('127.0.0.1', 0))
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = args.file
+        if not path:
+            path = os.path.join(directory, 'bench.ogg')
+            write_ogg(path, int(args.duration / DELAY) + 100)
+
+        print(f'{"player":8} {"sources":8} {"sessions":>8} {"threads":>8} {"cpu %":>7} {"ctx sw/s":>9} {"frames/s":>9} {"p50 ms":>7} {"p99 ms":>7} {"max ms":>8} {"gaps %":>7} {"healthy gaps %":>14}')
+        for kind in args.sources or ('file', 'stalling'):
+            for sessions in args.sessions or (10, 100, 500):
+                for mode in ('thread', 'engine'):
+                    result = run(mode, kind, sessions, path, loop, receiver.getsockname())
+                    print(f'{mode:8} {kind:8} {sessions:8} {result["threads"]:8} {result["cpu %"]:7.1f} {result["ctx sw/s"]:9.0f} {result["frames/s"]:9.0f} {result["p50 ms"]:7.2f} {result["p99 ms"]:7.2f} {result["max ms"]:8.2f} {result["gaps %"]:7.2f} {result["healthy gaps %"]:14.2f}')
+    receiver.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,429 @@
+#!/usr/bin/python3
+# Offline load test of command dispatch: the bot from bot.py with ext.misc,
+# ext.totpal and ext.music against a fake gateway, HTTP layer, voice client,
+# FFmpeg and youtube-dl
+#
+#   python3 bench/load.py [-s SCENARIO ...] [-n COMMANDS] [-c CONCURRENCY] [BOT OPTIONS]
+#
+# Options not known here are passed on to the bot and its extensions, e.g.
+# --extract-workers 8. Every scenario runs twice, the second time under
+# tracemalloc for the memory column.
+import argparse
+import asyncio
+from datetime import datetime, timezone
+import itertools
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SCENARIOS = ('mixed', 'guilds', 'queue', 'totpal', 'burst', 'search', 'settings')
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-s', '--scenario', action='extend', nargs='*', choices=SCENARIOS, help='Scenarios to run. Defaults to all')
+parser.add_argument('-n', '--commands', default=5000, type=int, help='Commands per scenario. Defaults to 5000')
+parser.add_argument('-c', '--concurrency', default=100, type=int, help='Commands in flight at once. Defaults to 100')
+parser.add_argument('--extract-latency', default=0.002, type=float, help='Seconds a fake extraction blocks its worker. Defaults to 0.002')
+parser.add_argument('--seed', default=0, type=int, help='Random seed. Defaults to 0')
+args, passthrough = parser.parse_known_args()
+
+# bot.py and the extensions read their options from sys.argv
+sys.argv = ['bot.py', '-t', 'offline', *passthrough]
+
+import discord
+from discord.ext import commands
+import utils.extractor
+from utils import outbox
+import bot as bot_module
+
+bot = bot_module.bot
+state = bot._connection
+ids = itertools.count(10**17)
+NOW = datetime.now(timezone.utc).isoformat()
+
+
+# youtube-dl
+class FakeYoutubeDL:
+    """Answers like YouTube would, after blocking the worker for a moment"""
+    def __init__(self, opts):
+        self.opts = opts
+
+    @staticmethod
+    def video(video_id):
+        return {'id': video_id, 'title': f'Song {video_id}', 'webpage_url': f'https://bench.invalid/watch?v={video_id}', 'duration': 200, 'extractor': 'bench'}
+
+    def extract_info(self, url, download=False, ie_key=None, process=True):
+        time.sleep(args.extract_latency)
+        if url.startswith('https://bench.invalid/playlist/'):
+            n = int(url.rsplit('/', 1)[1])
+            entries = ({'_type': 'url', 'url': f'https://bench.invalid/watch?v=p{i}', 'title': f'Song p{i}', 'duration': 200} for i in range(n))
+            return {'_type': 'playlist', 'title': f'Playlist of {n}', 'entries': entries}
+        if url.startswith('ytsearch'):
+            n, query = url[len('ytsearch'):].split(':', 1)
+            video_id = query.lower().replace(' ', '-')
+            entries = ({'_type': 'url', 'ie_key': 'Youtube', 'url': f'{video_id}-{i}', 'title': f'Song {video_id}-{i}', 'duration': 200} for i in range(int(n)))
+            return {'_type': 'playlist', 'title': query, 'entries': entries}
+        video_id = url.rsplit('=', 1)[1] if '://' in url else url.lower().replace(' ', '-')
+        return self.video(video_id)
+
+    def process_ie_result(self, ie_result, download=False):
+        time.sleep(args.extract_latency)
+        if ie_result.get('_type') == 'url':
+            ie_result = self.video(ie_result['url'].rsplit('=', 1)[1])
+        return dict(ie_result, url=f'https://bench.invalid/stream/{ie_result["id"]}.webm', ext='webm', acodec='opus', abr=128, asr=48000)
+
+utils.extractor.YoutubeDL = FakeYoutubeDL
+
+
+# FFmpeg
+class FakeOpus(discord.AudioSource):
+    def read(self):
+        return b'\xf8\xff\xfe'
+
+    def is_opus(self):
+        return True
+
+def open_fake(self, offset):
+    return FakeOpus()
+
+
+# Voice
+class FakeVoiceClient:
+    """Plays until stopped, songs don't end on their own"""
+    def __init__(self, channel):
+        self.channel = channel
+        self.guild = channel.guild
+        self.source = None
+        self._after = None
+        self._paused = False
+        self._connected = True
+
+    def is_connected(self):
+        return self._connected
+
+    def is_playing(self):
+        return self.source is not None and not self._paused
+
+    def is_paused(self):
+        return self.source is not None and self._paused
+
+    def play(self, source, *, after=None):
+        if self.source:
+            raise discord.ClientException('Already playing audio.')
+        self.source, self._after = source, after
+        source.read()
+
+    def pause(self):
+        self._paused = True
+
+    def resume(self):
+        self._paused = False
+
+    def stop(self):
+        source, after = self.source, self._after
+        self.source, self._after, self._paused = None, None, False
+        if source:
+            source.cleanup()
+            if after:
+                after(None)
+
+    async def disconnect(self, *, force=False):
+        self._connected = False
+        self.stop()
+
+async def connect(channel, *, timeout=60.0, reconnect=True, cls=None):
+    return FakeVoiceClient(channel)
+
+discord.VoiceChannel.connect = connect
+
+
+# HTTP
+def user_data(user_id):
+    return {'id': str(user_id), 'username': f'user{user_id}', 'discriminator': '0001', 'avatar': None}
+
+def message_data(channel_id, author, content, guild_id=None):
+    data = {
+        'id': str(next(ids)), 'channel_id': str(channel_id), 'author': author, 'content': content,
+        'timestamp': NOW, 'edited_timestamp': None, 'tts': False, 'mention_everyone': False,
+        'mentions': [], 'mention_roles': [], 'attachments': [], 'embeds': [], 'pinned': False, 'type': 0,
+    }
+    if guild_id:
+        data['guild_id'] = str(guild_id)
+        data['member'] = {'roles': [], 'joined_at': NOW, 'deaf': False, 'mute': False}
+    return data
+
+sent = 0
+# requests Discord would have answered with 429
+limited = 0
+windows = {}
+
+async def request(route, *, files=None, form=None, **kwargs):
+    global sent, limited
+    sent += 1
+    limit = outbox.LIMITS.get((route.method, route.path))
+    if limit:
+        window = windows.setdefault((route.method, route.bucket), [])
+        now = time.monotonic()
+        window[:] = [t for t in window if t > now - limit[1]]
+        if len(window) >= limit[0]:
+            limited += 1
+        window.append(now)
+    if route.method == 'POST' and route.path == '/channels/{channel_id}/messages':
+        payload = kwargs.get('json', {})
+        data = message_data(route.channel_id, user_data(bot.user.id), payload.get('content') or '')
+        if payload.get('embed'):
+            data['embeds'] = [payload['embed']]
+        return data
+    if route.path == '/users/@me/channels':
+        return dm_data(kwargs['json']['recipient_id'])
+    return None
+
+# the outbox paces and coalesces in front of the fake
+bot.outbox.downstream = request
+
+
+# Gateway
+def dm_data(user_id):
+    return {'id': str(int(user_id) + 1), 'type': 1, 'recipients': [user_data(user_id)]}
+
+def add_guild(members):
+    """Create a guild with a text and a voice channel, all members are in the voice channel"""
+    guild_id = next(ids)
+    text_id, voice_id = next(ids), next(ids)
+    users = [next(ids) * 2 for _ in range(members)]
+    state._add_guild_from_data({
+        'id': str(guild_id), 'name': f'guild {guild_id}', 'owner_id': str(users[0]), 'region': 'europe',
+        'member_count': members + 1, 'large': False, 'features': [], 'emojis': [],
+        'roles': [{'id': str(guild_id), 'name': '@everyone', 'permissions': '104324673', 'position': 0, 'color': 0, 'hoist': False, 'managed': False, 'mentionable': False}],
+        'channels': [
+            {'id': str(text_id), 'type': 0, 'name': 'text', 'position': 0},
+            {'id': str(voice_id), 'type': 2, 'name': 'voice', 'position': 1, 'bitrate': 64000, 'user_limit': 0},
+        ],
+        'members': [{'user': user_data(user), 'roles': [], 'joined_at': NOW, 'deaf': False, 'mute': False} for user in users],
+        'voice_states': [
+            {'user_id': str(user), 'channel_id': str(voice_id), 'session_id': 'bench', 'deaf': False, 'mute': False,
+             'self_deaf': False, 'self_mute': False, 'self_video': False, 'suppress': False}
+            for user in users
+        ],
+    })
+    for user in users:
+        state.add_dm_channel(dm_data(user))
+    return guild_id, text_id, users
+
+
+# Driving commands
+class Driver:
+    def __init__(self):
+        self.pending = {}
+        self.latencies = []
+        self.checks = 0
+        self.errors = 0
+
+    async def on_command_completion(self, ctx):
+        self.done(ctx.message.id)
+
+    async def on_command_error(self, ctx, error):
+        # failed checks are expected, e.g. $skip when nothing is playing
+        if isinstance(error, commands.CheckFailure):
+            self.checks += 1
+        else:
+            self.errors += 1
+        self.done(ctx.message.id)
+
+    def done(self, message_id):
+        pending = self.pending.pop(message_id, None)
+        if pending:
+            started, future = pending
+            self.latencies.append(time.perf_counter() - started)
+            future.set_result(None)
+
+    async def send(self, guild_id, channel_id, user, content):
+        data = message_data(channel_id if guild_id else int(user) + 1, user_data(user), content, guild_id)
+        future = bot.loop.create_future()
+        self.pending[int(data['id'])] = (time.perf_counter(), future)
+        state.parse_message_create(data)
+        try:
+            await asyncio.wait_for(future, 30.0)
+        except asyncio.TimeoutError:
+            self.pending.pop(int(data['id']), None)
+            self.errors += 1
+
+    async def run(self, traffic):
+        """Send (guild id, channel id, user id, content) with limited concurrency"""
+        traffic = iter(traffic)
+
+        async def worker():
+            for command in traffic:
+                await self.send(*command)
+
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+
+
+def pick(rng, guilds):
+    guild_id, text_id, users = rng.choice(guilds)
+    return guild_id, text_id, rng.choice(users)
+
+async def wait_for_ingest():
+    music = bot.get_cog('Music')
+    while any(player.ingest_task for player in music.players.values()):
+        await asyncio.sleep(0.01)
+
+def scenario_mixed(rng, n):
+    """Everyday traffic in 50 guilds of 10 members"""
+    guilds = [add_guild(10) for _ in range(50)]
+    setup = [(g, t, users[0], f'$play song {g}') for g, t, users in guilds]
+    # a number past int()'s digit limit has to fail like any other bad expression
+    contents = ['$roll 3d6+2', '$coin', '$ping', '$players', '$queue', '$play song {}', '$join', '$random', '$source', '$roll 1d' + '9' * 5000]
+    return [setup], [(*pick(rng, guilds), rng.choice(contents).format(rng.randrange(500))) for _ in range(n)]
+
+def scenario_guilds(rng, n):
+    """Music in many guilds at once"""
+    guilds = [add_guild(3) for _ in range(max(1, n // 4))]
+    setup = [(g, t, users[0], f'$play song {g}') for g, t, users in guilds]
+    traffic = []
+    for g, t, users in guilds:
+        traffic += [(g, t, users[0], f'$play song {g} {i}') for i in range(2)]
+        traffic += [(g, t, users[1], '$queue'), (g, t, users[2], '$skip')]
+    return [setup], traffic[:n]
+
+def scenario_queue(rng, n):
+    """Queue management on a 5000 song playlist"""
+    g, t, users = add_guild(5)
+    setup = [(g, t, users[0], '$play https://bench.invalid/playlist/5000')]
+    contents = ['$queue {}', '$move {} {}', '$remove {}', '$playnext song {}', '$shuffle', '$dedupe', '$queue']
+    traffic = [(g, t, rng.choice(users), rng.choice(contents).format(rng.randrange(1, 300), rng.randrange(1, 300))) for _ in range(n)]
+    return [setup], traffic
+
+def scenario_totpal(rng, n):
+    """Totpal in 100 channels with 20 players each"""
+    guilds = [add_guild(20) for _ in range(100)]
+    join = [(g, t, user, '$join') for g, t, users in guilds for user in users]
+    articles = [(None, None, user, f'$set Article of {user}') for g, t, users in guilds for user in users]
+    contents = ['$random', '$players', '$my', '$random']
+    traffic = []
+    for _ in range(n):
+        g, t, user = pick(rng, guilds)
+        content = rng.choice(contents)
+        traffic.append((None, None, user, content) if content == '$my' and rng.random() < 0.5 else (g, t, user, content))
+    return [join, articles], traffic
+
+def scenario_burst(rng, n):
+    """Bursts in 20 busy channels under Discord's rate limits"""
+    guilds = [add_guild(10) for _ in range(20)]
+    setup = [(g, t, users[0], f'$play song {g}') for g, t, users in guilds]
+    # $load fails the owner check, $play reacts and replies, so its reaction can be dropped
+    contents = ['$roll 3d6', '$coin', '$shuffle', '$pause', '$resume', '$load ext.misc', '$play burst song']
+    return [setup], [(*pick(rng, guilds), rng.choice(contents)) for _ in range(n)]
+
+def scenario_search(rng, n):
+    """Searching and picking from 50 popular queries in 50 guilds"""
+    guilds = [add_guild(10) for _ in range(50)]
+    setup = [(g, t, users[0], f'$play song {g}') for g, t, users in guilds]
+    traffic = []
+    for _ in range(n // 2):
+        g, t, user = pick(rng, guilds)
+        traffic += [(g, t, user, f'$search song {rng.randrange(50)}'), (g, t, user, f'$pick {rng.randrange(1, 6)}')]
+    return [setup], traffic
+
+def scenario_settings(rng, n):
+    """Members without Manage Server trying to change settings in 50 guilds and in private messages"""
+    guilds = [add_guild(10) for _ in range(50)]
+    contents = ['$settings set prefix !', '$settings reset prefix', '$settings set queue_limit 1', '$settings']
+    traffic = []
+    for _ in range(n):
+        # users[0] owns the guild
+        g, t, users = rng.choice(guilds)
+        user = rng.choice(users[1:])
+        traffic.append((None, None, user, rng.choice(contents)) if rng.random() < 0.1 else (g, t, user, rng.choice(contents)))
+    return [], traffic
+
+
+async def reset():
+    """Forget the state of the previous run"""
+    global limited
+    limited = 0
+    windows.clear()
+    music = bot.get_cog('Music')
+    for guild_id in list(music.players):
+        await music.free_player(guild_id)
+    totpal = bot.get_cog('Totpal')
+    totpal.sessions.clear()
+    totpal.joined.clear()
+    # _remove_guild() runs a full gc.collect() per guild
+    state._guilds.clear()
+
+async def run_scenario(name, memory):
+    await reset()
+    # the other scenarios measure dispatch, not Discord's rate limits
+    bot.outbox.limits = outbox.LIMITS if name == 'burst' else {}
+    rng = random.Random(args.seed)
+    setup, traffic = globals()[f'scenario_{name}'](rng, args.commands)
+    driver = Driver()
+    bot.add_listener(driver.on_command_completion)
+    bot.add_listener(driver.on_command_error)
+    try:
+        for phase in setup:
+            await driver.run(phase)
+        await wait_for_ingest()
+        driver.latencies, driver.checks, driver.errors = [], 0, 0
+
+        if memory:
+            tracemalloc.start()
+            baseline = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        await driver.run(traffic)
+        elapsed = time.perf_counter() - started
+        peak = 0
+        if memory:
+            peak = tracemalloc.get_traced_memory()[1] - baseline
+            tracemalloc.stop()
+    finally:
+        bot.remove_listener(driver.on_command_completion)
+        bot.remove_listener(driver.on_command_error)
+
+    latencies = sorted(driver.latencies)
+    return {
+        'commands': len(traffic),
+        'checks': driver.checks,
+        'errors': driver.errors,
+        'cmd/s': len(traffic) / elapsed,
+        'p50 ms': statistics.median(latencies) * 1000,
+        'p99 ms': latencies[int(len(latencies) * 0.99)] * 1000,
+        'peak B/cmd': peak / len(traffic),
+    }
+
+async def main():
+    state.user = discord.ClientUser(state=state, data=user_data(next(ids)))
+    # nobody, with 0 is_owner() would ask the API
+    bot.owner_id = 1
+    for extension in ('ext.misc', 'ext.totpal', 'ext.music'):
+        bot.load_extension(extension)
+    # load_extension() executes a fresh copy of the module
+    bot.extensions['ext.music'].StreamSource._open = open_fake
+
+    print(f'{"scenario":10} {"commands":>9} {"checks":>7} {"errors":>7} {"cmd/s":>9} {"p50 ms":>8} {"p99 ms":>8} {"peak B/cmd":>11}')
+    for name in args.scenario or SCENARIOS:
+        result = await run_scenario(name, memory=False)
+        rate_limited = limited
+        result['peak B/cmd'] = (await run_scenario(name, memory=True))['peak B/cmd']
+        print(f'{name:10} {result["commands"]:9} {result["checks"]:7} {result["errors"]:7} {result["cmd/s"]:9.0f} {result["p50 ms"]:8.2f} {result["p99 ms"]:8.2f} {result["peak B/cmd"]:11.0f}')
+        if name == 'burst':
+            print(f'{"":10} outbox {bot.outbox.stats()}, rate limited {rate_limited}')
+        if name == 'settings':
+            changed = [guild.id for guild in bot.guilds if await bot.settings.overridden(guild.id)]
+            print(f'{"":10} guilds with settings changed {len(changed)}, every command should fail its checks')
+
+    await reset()
+    for extension in list(bot.extensions):
+        bot.unload_extension(extension)
+
+
+if __name__ == '__main__':
+    try:
+        bot.loop.run_until_complete(main())
+    finally:
+        bot_module.log_listener.stop()
@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+# Totpal games: dict with copy-and-retry random vs. array plus index
+#
+#   python3 bench/totpal_sessions.py [-s SESSIONS] [-p PLAYERS] [-r ROUNDS]
+#
+# Every session gets PLAYERS articles, then each round every player draws a
+# random article, one player leaves and rejoins.
+import argparse
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.argv, argv = sys.argv[:1], sys.argv[1:]
+from ext.totpal import Game, logger
+
+logging.disable(logging.INFO)
+
+
+class DictGame:
+    """The previous implementation"""
+    def __init__(self):
+        self.d = {}
+
+    def add(self, user, article):
+        logger.info(f'Set Article: {user}: {article}')
+        self.d[user] = article
+
+    def remove(self, user):
+        logger.info(f'Remove player: {user}')
+        del self.d[user]
+
+    def random(self, user):
+        r = random.choice(list(self.d.items()))
+        if r[0] != user:
+            logger.info(f'Random article: {r[1]}')
+            return r[1]
+        else:
+            return self.random(user)
+
+
+def run(game_class, sessions, players, rounds):
+    games = {(0, s): game_class() for s in range(sessions)}
+    started = time.perf_counter()
+    for (_, s), game in games.items():
+        for p in range(players):
+            game.add(s * players + p, f'Article {p}')
+    added = time.perf_counter()
+
+    for _ in range(rounds):
+        for (_, s), game in games.items():
+            for p in range(players):
+                game.random(s * players + p)
+    drawn = time.perf_counter()
+
+    for _ in range(rounds):
+        for (_, s), game in games.items():
+            user = s * players + random.randrange(players)
+            game.remove(user)
+            game.add(user, 'Another article')
+    done = time.perf_counter()
+
+    operations = sessions * players
+    return {
+        'add': (added - started) / operations,
+        'random': (drawn - added) / (operations * rounds),
+        'remove+add': (done - drawn) / (sessions * rounds),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--sessions', default=5000, type=int, help='Number of concurrent games. Defaults to 5000')
+    parser.add_argument('-p', '--players', default=20, type=int, help='Players per game. Defaults to 20')
+    parser.add_argument('-r', '--rounds', default=5, type=int, help='Rounds per game. Defaults to 5')
+    args = parser.parse_args(argv)
+
+    random.seed(0)
+    old = run(DictGame, args.sessions, args.players, args.rounds)
+    new = run(Game, args.sessions, args.players, args.rounds)
+    print(f'{"ns/op":12} {"dict":>10} {"indexed":>10}')
+    for op in old:
+        print(f'{op:12} {old[op] * 1e9:10.0f} {new[op] * 1e9:10.0f}')
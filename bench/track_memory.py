@@ -0,0 +1,76 @@
+#!/usr/bin/python3
+# Memory per queued song: full youtube-dl info dicts vs. Track records
+#
+#   python3 bench/track_memory.py [-n N]
+#
+# The info dicts are synthetic but shaped like a YouTube extraction
+# (formats with signed URLs and http_headers, thumbnails, description).
+import argparse
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.track import Track
+
+
+def stream_url(video_id, itag):
+    return f'https://rr3---sn-4g5e6nzz.googlevideo.com/videoplayback?expire=1700000000&ei=abc&ip=203.0.113.7&id=o-{video_id}&itag={itag}&source=youtube' + '&sig=' + 'A' * 700
+
+def fake_info(i):
+    video_id = f'vid{i:08d}'
+    formats = []
+    for itag in range(20):
+        formats.append({
+            'format_id': str(itag),
+            'url': stream_url(video_id, itag),
+            'ext': 'webm' if itag % 2 else 'm4a',
+            'acodec': 'opus' if itag % 2 else 'mp4a.40.2',
+            'vcodec': 'none',
+            'abr': 48.0 + itag,
+            'asr': 48000,
+            'tbr': 50.0 + itag,
+            'filesize': 3000000 + itag,
+            'format_note': 'tiny',
+            'http_headers': {
+                'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+                'Accept-Charset': 'ISO-8859-1,utf-8;q=0.7,*;q=0.7',
+                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+                'Accept-Encoding': 'gzip, deflate',
+                'Accept-Language': 'en-us,en;q=0.5',
+            },
+        })
+    info = dict(formats[-1])
+    info.update({
+        'id': video_id,
+        'title': f'Some song title number {i}',
+        'webpage_url': f'https://www.youtube.com/watch?v={video_id}',
+        'duration': 215,
+        'description': 'Lorem ipsum dolor sit amet. ' * 40,
+        'thumbnails': [{'url': f'https://i.ytimg.com/vi/{video_id}/hq{n}.jpg', 'width': 120 * n, 'height': 90 * n, 'id': str(n)} for n in range(5)],
+        'tags': [f'tag{n}' for n in range(15)],
+        'formats': formats,
+        'requester': object(),
+    })
+    return info
+
+
+def measure(build, n):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    queue = [build(i) for i in range(n)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / len(queue)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', default=1000, type=int, help='Number of queued songs. Defaults to 1000')
+    args = parser.parse_args()
+
+    info = measure(fake_info, args.n)
+    track = measure(lambda i: Track.from_info(fake_info(i), 123456789012345678), args.n)
+    print(f'info dict: {info:10.0f} bytes/song')
+    print(f'Track:     {track:10.0f} bytes/song')
+    print(f'ratio:     {info / track:10.1f}x')
@@ -1,10 +1,35 @@
 #!/usr/bin/python3
+import time
+# Startup is timed from here, before the slow imports
+STARTED = time.perf_counter()
+
 import argparse
+import ast
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import importlib
+import importlib.util
+import io
 import logging
+import os
+import shutil
 import signal
+import sys
+import tempfile
+
+import discord
 
 from discord.ext import commands
 
+from utils import logqueue
+from utils.cluster import ClusterClient, Supervisor, shard_range
+from utils.metrics import Registry, monitor_loop
+from utils.outbox import CHECK_FAILURE, Outbox, origin, priority
+from utils.reloader import Reloader
+from utils.scheduler import Scheduler
+from utils.settings import Settings
+from utils.watchdog import Watchdog, sample
+
 # Command line arguments
 parser = argparse.ArgumentParser()
 parser.add_argument('-t', '--token', required=True, help='Discord Bot Token')
@@ -12,6 +37,18 @@ parser.add_argument('-l', '--log', default='WARNING', help='Log Level. One of [D
 parser.add_argument('-s', '--systemd', action='store_true', help='Bot is running as a systemd service')
 parser.add_argument('-p', '--prefix', default='$', help='Bot commands prefix')
 parser.add_argument('-e', '--extension', action='extend', nargs='*', help='Name of the python file with an discord.py extension. See https://discordpy.readthedocs.io/en/stable/ext/commands/extensions.html#ext-commands-extensions')
+parser.add_argument('--metrics', default=None, type=int, metavar='PORT', help='Serve Prometheus metrics on this port')
+parser.add_argument('--metrics-host', default='127.0.0.1', help='Address to serve metrics on. Defaults to 127.0.0.1')
+parser.add_argument('--settings-db', default=None, help='Path of an sqlite database for per server settings. Settings are lost on restart without it')
+parser.add_argument('--settings-cache', default=1024, type=int, help='Number of servers whose settings are kept in memory. Defaults to 1024')
+parser.add_argument('--log-buffer', default=10000, type=int, help='Log records waiting to be written before further ones are dropped. Defaults to 10000')
+parser.add_argument('--watch', action='store_true', help='Reload extensions when their source files change')
+parser.add_argument('--shards', default=None, type=int, help='Total number of shards. Runs an AutoShardedBot, defaults to one shard per cluster with --clusters')
+parser.add_argument('--clusters', default=1, type=int, help='Run the shards in this many worker processes, each owning a contiguous slice. Defaults to 1')
+# set by the cluster supervisor for its workers
+parser.add_argument('--cluster-id', default=None, type=int, help=argparse.SUPPRESS)
+parser.add_argument('--ipc', default=None, help=argparse.SUPPRESS)
+parser.add_argument('--stall-threshold', default=1.0, type=float, help='Log the stack when the event loop is blocked longer than this in sec. Defaults to 1')
 args = parser.parse_known_args()
 
 # Logging Config
@@ -25,11 +62,13 @@ if args[0].systemd:
     
     # if handler is atteched to root logger, all events by descendant loggers get logged
     # see note on https://docs.python.org/3.10/library/logging.html#logging.Logger.propagate
-    discord_logger.addHandler(journal.JournaldLogHandler())
+    handler = journal.JournaldLogHandler()
 else:
     handler = logging.StreamHandler()
     handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
-    discord_logger.addHandler(handler)
+
+# Formatting and writing happens on a background thread, not the event loop
+log_queue, log_listener = logqueue.start(discord_logger, [handler], args[0].log_buffer)
 
 # Set log level
 NUMERIC_LOG_LEVEL = getattr(logging, args[0].log.upper(), None)
@@ -37,88 +76,286 @@ if not isinstance(NUMERIC_LOG_LEVEL, int):
     raise ValueError(f'Invalid log level: {args[0].log}')
 logger.setLevel(NUMERIC_LOG_LEVEL)
 
+# Cluster supervisor, the bot itself runs in the worker processes
+if __name__ == '__main__' and args[0].clusters > 1 and args[0].cluster_id is None:
+    ipc_dir = tempfile.mkdtemp()
+    supervisor = Supervisor([sys.executable, *sys.argv], args[0].clusters, os.path.join(ipc_dir, 'cluster.sock'))
+    if args[0].systemd:
+        # READY once every shard is up, WATCHDOG only while every worker loop is healthy,
+        # also while workers are still starting
+        supervisor.on_ready = lambda: notify(Notification.READY)
+        if os.environ.get('WATCHDOG_USEC'):
+            supervisor.on_alive = lambda: notify(Notification.WATCHDOG)
+            supervisor.alive_interval = int(os.environ['WATCHDOG_USEC']) / 2e6
+            supervisor.alive_timeout = int(os.environ['WATCHDOG_USEC']) / 1e6
+    try:
+        asyncio.run(supervisor.run())
+    finally:
+        shutil.rmtree(ipc_dir, ignore_errors=True)
+        log_listener.stop()
+    sys.exit()
+
+
+# Per server settings, extensions register their own
+settings = Settings(args[0].settings_db, args[0].settings_cache)
+
+def prefix_setting(text):
+    if not 0 < len(text) <= 10:
+        raise ValueError('use 1 to 10 characters')
+    return text
+
+settings.register('prefix', prefix_setting, args[0].prefix, 'Commands prefix', pinned=True)
+prefixes = settings.pinned('prefix')
+
+def command_prefix(bot, message):
+    # runs for every message, a dict lookup without touching the database
+    guild = message.guild
+    return prefixes.get(guild.id, args[0].prefix) if guild else args[0].prefix
 
 
 # Define bot
-bot = commands.Bot(command_prefix=args[0].prefix, case_insensitive=True, help_command=commands.DefaultHelpCommand(verify_checks=False, no_category='Other', sort_commands=False))
+bot_options = dict(command_prefix=command_prefix, case_insensitive=True, help_command=commands.DefaultHelpCommand(verify_checks=False, no_category='Other', sort_commands=False))
+if args[0].shards or args[0].clusters > 1:
+    shard_count = args[0].shards or args[0].clusters
+    shard_ids = list(shard_range(shard_count, args[0].clusters, args[0].cluster_id or 0))
+    bot = commands.AutoShardedBot(shard_count=shard_count, shard_ids=shard_ids, **bot_options)
+else:
+    bot = commands.Bot(**bot_options)
+
+# Messages and reactions are queued per channel, paced by the rate limits and coalesced
+bot.outbox = Outbox(bot.http.request)
+bot.http.request = bot.outbox.request
+
+bot.settings = settings
+
+# Deadlines shared by all extensions
+bot.scheduler = Scheduler(bot.loop)
+
+# Metrics, extensions register their own
+bot.metrics = Registry()
+# Event loop watchdog, feeds the systemd watchdog while the loop is healthy
+watchdog = Watchdog(args[0].stall_threshold)
+if args[0].systemd and os.environ.get('WATCHDOG_USEC'):
+    # cluster workers report to the supervisor, which feeds systemd, more often than it checks
+    watchdog.notify = (lambda: bot.cluster.alive()) if args[0].ipc else (lambda: notify(Notification.WATCHDOG))
+    watchdog.notify_interval = int(os.environ['WATCHDOG_USEC']) / (8e6 if args[0].ipc else 2e6)
+
+async def start_watchdog():
+    watchdog.start()
+
+bot.loop.create_task(start_watchdog())
+bot.metrics.gauge('bot_log_dropped', 'Log records dropped because the log queue was full', func=lambda: log_queue.dropped)
+bot.metrics.gauge('bot_outbox_pending', 'Messages and reactions waiting for a rate limit', func=lambda: bot.outbox.depth)
+bot.metrics.gauge('bot_outbox', 'Outbox counters and time spent waiting for rate limits', ('stat',), func=lambda: {(k,): v for k, v in bot.outbox.stats().items()})
+bot.metrics.gauge('bot_settings_cache', 'Settings cache counters', ('stat',), func=lambda: {(k,): v for k, v in settings.stats().items()})
+bot.metrics.gauge('bot_loop_stalls', 'Times the event loop was blocked longer than the stall threshold', func=lambda: watchdog.stalls)
+
+# Reloads only what changed since it was loaded
+bot.reloader = Reloader(bot, os.path.dirname(os.path.abspath(__file__)))
+
+extension_seconds = bot.metrics.histogram('bot_extension_load_seconds', 'Time to import, load, unload or reload an extension', ('extension', 'action'))
+startup_seconds = bot.metrics.gauge('bot_startup_seconds', 'Seconds from process start to the end of a startup stage', ('stage',))
+ready_after = None
 
 # On bot ready
 @bot.event
 async def on_ready():
     logger.info('Logged in as')
-    logger.info(f'User: {bot.user.name}')
-    logger.info(f'ID: {bot.user.id}')
+    logger.info('User: %s', bot.user.name)
+    logger.info('ID: %s', bot.user.id)
     logger.info('----------------------')
-    if args[0].systemd:
+    global ready_after
+    if ready_after is None:
+        ready_after = time.perf_counter() - STARTED
+        startup_seconds.set(ready_after, ('ready',))
+        logger.info('Ready %.2f s after start', ready_after)
+    if bot.cluster:
+        # the supervisor notifies systemd once every cluster is ready
+        bot.cluster.ready()
+    elif args[0].systemd:
         notify(Notification.READY)
 
+# Replies and reactions sent while handling a message belong to its command
+@bot.event
+async def on_message(message):
+    with origin(message.id):
+        await bot.process_commands(message)
+
 # Global command errors
 @bot.event
 async def on_command_error(ctx, error):
-    if isinstance(error, commands.NoPrivateMessage):
-        await ctx.send('This command cannot be used in private messages.')
-    elif isinstance(error, commands.PrivateMessageOnly):
-        await ctx.send('Please us private messages for this command.')
-    elif isinstance(error, commands.NotOwner):
-        await ctx.send('Sorry. You cannot use this command.')
-    elif isinstance(error, commands.DisabledCommand):
-        await ctx.send('Sorry. This command is disabled and cannot be used.')
+    # replies to working commands go first
+    with priority(CHECK_FAILURE):
+        if isinstance(error, commands.NoPrivateMessage):
+            await ctx.send('This command cannot be used in private messages.')
+        elif isinstance(error, commands.PrivateMessageOnly):
+            await ctx.send('Please us private messages for this command.')
+        elif isinstance(error, commands.NotOwner):
+            await ctx.send('Sorry. You cannot use this command.')
+        elif isinstance(error, commands.DisabledCommand):
+            await ctx.send('Sorry. This command is disabled and cannot be used.')
+
+# Command metrics
+if args[0].metrics:
+    commands_total = bot.metrics.counter('bot_commands_total', 'Invoked commands by outcome', ('command', 'outcome'))
+    command_seconds = bot.metrics.histogram('bot_command_seconds', 'Time from invoking a command to its completion', ('command',))
+
+    @bot.listen()
+    async def on_command(ctx):
+        ctx.invoked_at = time.perf_counter()
+
+    @bot.listen()
+    async def on_command_completion(ctx):
+        command = ctx.command.qualified_name
+        commands_total.inc((command, 'ok'))
+        command_seconds.observe(time.perf_counter() - ctx.invoked_at, (command,))
+
+    @bot.listen('on_command_error')
+    async def count_command_error(ctx, error):
+        # unknown commands never get invoked
+        command = ctx.command.qualified_name if ctx.command else ''
+        commands_total.inc((command, 'check_failed' if isinstance(error, commands.CheckFailure) else 'error'))
+        if hasattr(ctx, 'invoked_at'):
+            command_seconds.observe(time.perf_counter() - ctx.invoked_at, (command,))
+
+    bot.metrics.gauge('bot_gateway_latency_seconds', 'Heartbeat latency of the gateway connection', func=lambda: bot.latency)
+    bot.metrics.gauge('bot_guilds', 'Number of guilds the bot is in', func=lambda: len(bot.guilds))
+    loop_lag = bot.metrics.gauge('bot_loop_lag_seconds', 'How late the event loop last woke up a sleeping task')
+    loop_lag_seconds = bot.metrics.histogram('bot_loop_lag_seconds_distribution', 'How late the event loop wakes up sleeping tasks', buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0))
+
+    async def start_metrics():
+        await bot.metrics.serve(args[0].metrics_host, args[0].metrics)
+        await monitor_loop(loop_lag, loop_lag_seconds)
+
+    bot.loop.create_task(start_metrics())
 
 # Ping-pong command
 @bot.command(hidden=True)
 async def ping(ctx):
     await ctx.send('Pong')
 
+# Extension management shared by the owner commands and the other clusters
+EXTENSION_ACTIONS = ('load', 'unload', 'reload', 'extensions')
+
+def extension_action(action, module=None):
+    """Run an owner action on this process and return the reply"""
+    if action not in EXTENSION_ACTIONS:
+        raise ValueError(f'Unknown action {action}')
+    if action == 'extensions':
+        return f'Currently loaded extensions: `{"`, `".join(list(bot.extensions.keys()))}`'
+    try:
+        if action == 'reload':
+            # module and everything using it, or every extension affected by a changed file
+            with extension_seconds.time((module or 'changed', 'reload')):
+                reloaded = bot.reloader.reload([module] if module else None)
+            if not reloaded:
+                return '✅ Nothing changed'
+            return f'✅ Reloaded `{"`, `".join(reloaded)}`'
+        else:
+            with extension_seconds.time((module, action)):
+                getattr(bot, f'{action}_extension')(module)
+            logger.info('%sed extension %s', action.capitalize(), module)
+            bot.reloader.snapshot()
+    except Exception as e:
+        logger.exception('Failed to %s extension %s', action, module)
+        return '🛑 `{}: {}`'.format(type(e).__name__, e)
+    return '✅ Sucess'
+
+async def everywhere(action, module=None):
+    """Run an owner action here and, in cluster mode, on every other cluster"""
+    reply = extension_action(action, module)
+    if not bot.cluster:
+        return reply
+    replies = await bot.cluster.broadcast(action, module)
+    replies[args[0].cluster_id] = reply
+    return '\n'.join(f'Cluster {cluster}: {reply}' for cluster, reply in sorted(replies.items()))
+
+# Connection to the cluster supervisor, None when running as a single process
+bot.cluster = None
+if args[0].ipc:
+    bot.cluster = ClusterClient(args[0].ipc, args[0].cluster_id, extension_action, on_lost=lambda: bot.loop.create_task(bot.close()))
+    bot.loop.create_task(bot.cluster.connect())
+
 # Manually load extension
 @bot.command(hidden=True)
 @commands.is_owner()
 async def load(ctx, module):
-    try:
-        bot.load_extension(module)
-        logger.info(f'Loaded extension {module}')
-    except Exception as e:
-        await ctx.send('🛑 `{}: {}`'.format(type(e).__name__, e))
-        logger.exception(f'Failed to load extension {module}')
-    else:
-        await ctx.send(f'✅ Sucess')
+    await ctx.send(await everywhere('load', module))
 
 # Manually unload extension
 @bot.command(hidden=True)
 @commands.is_owner()
 async def unload(ctx, module):
-    try:
-        bot.unload_extension(module)
-        logger.info(f'Unloaded extension {module}')
-    except Exception as e:
-        await ctx.send('🛑 `{}: {}`'.format(type(e).__name__, e))
-        logger.exception(f'Failed to unload extension {module}')
-    else:
-        await ctx.send(f'✅ Sucess')
+    await ctx.send(await everywhere('unload', module))
 
 # Manually reload extension
 @bot.command(hidden=True)
 @commands.is_owner()
 async def reload(ctx, module=None):
-    try:
-        if module:
-            bot.reload_extension(module)
-            logger.info(f'Reloaded extension {module}')
-        else:
-            logger.info('Reloading all extensions')
-            for extension in list(bot.extensions.keys()):
-                bot.reload_extension(extension.removesuffix('.py'))
-                logger.info(f'Reloaded extension {extension}')
-    except Exception as e:
-        await ctx.send('🛑 `{}: {}`'.format(type(e).__name__, e))
-        logger.exception(f'Failed to reload extension {module}')
-    else:
-        await ctx.send(f'✅ Sucess')
+    await ctx.send(await everywhere('reload', module))
+
+# Sample stacks of the running bot
+@bot.command(hidden=True)
+@commands.is_owner()
+async def profile(ctx, seconds: float = 10.0):
+    if not 0 < seconds <= 60:
+        await ctx.send('Profile for up to 60 seconds')
+        return
+    await ctx.message.add_reaction('⏱️')
+    stacks = await bot.loop.run_in_executor(None, sample, seconds)
+    await ctx.send(f'Collapsed stacks of {seconds:g} seconds, see https://www.speedscope.app', file=discord.File(io.BytesIO(stacks.encode()), 'profile.folded'))
 
 # list modules
 @bot.command(hidden=True, aliases=['extension', 'modules', 'module'])
 @commands.is_owner()
 async def extensions(ctx):
-    await ctx.send(f'Currently loaded extensions: `{"`, `".join(list(bot.extensions.keys()))}`')
+    await ctx.send(await everywhere('extensions'))
+
+# Per server settings, a group's checks don't run for its subcommands
+manage_settings = commands.check_any(commands.is_owner(), commands.has_guild_permissions(manage_guild=True))
+
+@bot.group(name='settings', invoke_without_command=True, brief='Show the settings of this server')
+@commands.guild_only()
+@manage_settings
+async def settings_command(ctx):
+    overridden = await settings.overridden(ctx.guild.id)
+    lines = []
+    for name, field in settings.fields.items():
+        value = overridden.get(name, field.default)
+        lines.append(f'`{name}`: `{value}`{"" if name in overridden else " (default)"} {field.help}')
+    await ctx.send('\n'.join(lines))
+
+@settings_command.command(name='set', brief='Change a setting of this server', usage='name value')
+@commands.guild_only()
+@manage_settings
+async def settings_set(ctx, name, *, value):
+    field = settings.fields.get(name)
+    if field is None:
+        await ctx.send(f'There is no setting `{name}`. See `{ctx.prefix}settings`')
+        return
+    try:
+        value = field.convert(value)
+    except ValueError as e:
+        await ctx.send(f'Invalid value for `{name}`: {e}')
+        return
+    await settings.set(ctx.guild.id, name, value)
+    logger.info('Set %s of guild id=%s to %s', name, ctx.guild.id, value)
+    await ctx.message.add_reaction('✅')
+
+@settings_command.command(name='reset', brief='Change a setting back to its default', usage='name')
+@commands.guild_only()
+@manage_settings
+async def settings_reset(ctx, name):
+    if name not in settings.fields:
+        await ctx.send(f'There is no setting `{name}`. See `{ctx.prefix}settings`')
+        return
+    await settings.reset(ctx.guild.id, name)
+    logger.info('Reset %s of guild id=%s', name, ctx.guild.id)
+    await ctx.message.add_reaction('✅')
+
+@bot.listen()
+async def on_guild_remove(guild):
+    settings.invalidate(guild.id)
 
 @bot.command(aliases=['github'], brief='Source Code')
 async def source(ctx):
@@ -126,33 +363,73 @@ async def source(ctx):
 
 
 
-# systemd reload
-def reloader(signum, frame):
-    logger.info('Reloading extensions because of SIGHUP')
-    for extension in list(bot.extensions.keys()):
-        try:
-            bot.reload_extension(extension.removesuffix('.py'))
-            logger.info(f'Reloaded extension {extension}')
-        except Exception:
-            logger.exception(f'Failed to reload extension {extension}')
+# Startup
+def dependencies(extension):
+    """Return the modules an extension imports at the top level"""
+    spec = importlib.util.find_spec(extension)
+    with open(spec.origin, 'rb') as file:
+        tree = ast.parse(file.read(), spec.origin)
+    modules = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            modules += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            modules.append(node.module)
+    return modules
 
+def preimport(extension):
+    """Import the modules an extension uses and return the seconds it took.
 
-if args[0].extension:
-    # Validate extension names
-    args[0].extension = [ext.replace('/', '.').removesuffix('.py') for ext in args[0].extension]
-    
-    # Load extensions
-    logger.info('Extension loading')
-    for extension in args[0].extension:
-        try:
-            bot.load_extension(extension.removesuffix('.py'))
-            logger.info(f'Loaded extension {extension}')
-        except Exception:
-            logger.exception(f'Failed to load extension {extension}')
-            args[0].extension.remove(extension)
-
-# systemd reload
-signal.signal(signal.SIGHUP, reloader)
-
-# Run bot
-bot.run(args[0].token)
+    Not the extension itself, load_extension executes a fresh copy of it anyway.
+    """
+    started = time.perf_counter()
+    try:
+        for module in dependencies(extension):
+            importlib.import_module(module)
+    except Exception:
+        # load_extension reports it
+        pass
+    return time.perf_counter() - started
+
+# systemd reload, on the event loop instead of interrupting it
+def reload_changed():
+    logger.info('Reloading changed extensions because of SIGHUP')
+    extension_action('reload')
+
+
+# Started directly, not imported by bench/load.py
+if __name__ == '__main__':
+    if args[0].extension:
+        # Validate extension names
+        startup_extensions = [ext.replace('/', '.').removesuffix('.py') for ext in args[0].extension]
+
+        # Imports run concurrently, so the modules extensions use are loaded
+        # already when they are set up one by one
+        logger.info('Extension loading')
+        with ThreadPoolExecutor(len(startup_extensions), 'import') as pool:
+            import_seconds = dict(zip(startup_extensions, pool.map(preimport, startup_extensions)))
+        for extension in startup_extensions:
+            extension_seconds.observe(import_seconds[extension], (extension, 'import'))
+            try:
+                started = time.perf_counter()
+                bot.load_extension(extension)
+                setup_seconds = time.perf_counter() - started
+                extension_seconds.observe(setup_seconds, (extension, 'load'))
+                logger.info('Loaded extension %s, imports %.0f ms, load %.0f ms', extension, import_seconds[extension] * 1000, setup_seconds * 1000)
+            except Exception:
+                logger.exception('Failed to load extension %s', extension)
+    startup_seconds.set(time.perf_counter() - STARTED, ('extensions',))
+
+    bot.reloader.snapshot()
+    if args[0].watch:
+        bot.loop.create_task(bot.reloader.watch())
+
+    # systemd reload
+    bot.loop.add_signal_handler(signal.SIGHUP, reload_changed)
+
+    # Run bot
+    try:
+        bot.run(args[0].token)
+    finally:
+        # write out what is still queued
+        log_listener.stop()
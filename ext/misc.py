@@ -3,6 +3,8 @@ import random
 
 from discord.ext import commands
 
+from utils import dice
+
 # Logger
 logger = logging.getLogger('discord.bot').getChild(__name__)
 
@@ -18,46 +20,29 @@ class Miscellaneous(commands.Cog):
         else:
             await ctx.send('Tails')
 
-    # Roll a dice
-    @commands.command(name='roll', aliases=['dice', 'die'], brief='Roll a die', usage='NdN±N', help='Defaults to a normal 6-sided die')
+    # Roll dice
+    @commands.command(name='roll', aliases=['dice', 'die'], brief='Roll dice', usage='[-v] [expression]',
+                      help='Defaults to a normal 6-sided die. Expressions are sums of dice and numbers, e.g. 2d20kh1+5 or 3d6!-2.\n'
+                           'NdS rolls N S-sided dice, d% is d100\n'
+                           '! explodes dice rolling their maximum\n'
+                           'khN/klN keep the N highest/lowest, dhN/dlN drop them\n'
+                           'Ending with a comparison like >= 15 tells success or failure\n'
+                           '-v shows every die')
     async def roll_dice(self, ctx, *args):
+        verbose = bool(args) and args[0] in ('-v', '--verbose')
+        if verbose:
+            args = args[1:]
+        # Default to 1d6
+        expression = ''.join(args) or 'd6'
         try:
-            # Default to 1d6+0
-            if args == ():
-                number_of_die = 1
-                sides = 6
-                modifier = 0
-
-            # Parse user input
-            else:
-                user_input = ''.join(args).lower()
-                if '+' in user_input:
-                    dice, modifier = user_input.split('+')
-                elif '-' in user_input:
-                    dice, modifier = user_input.split('-')
-                    modifier = int(modifier) * -1
-                else:
-                    dice = user_input
-                    modifier = 0
-
-                number_of_die, sides = dice.split('d')
-                if number_of_die == '':
-                    number_of_die = '1'
-            
-            # Calculate result
-            result = 0
-            for _ in range(int(number_of_die)):
-                result += random.randint(1, int(sides))
-            result += int(modifier)
-            
-            # Log and send
-            logger.info(f'Dice: {number_of_die}, Sides: {sides}, Modifier: {modifier}, Result: {result}')
-            await ctx.send(result)
-        
-        # Wrong format
-        except ValueError:
-            await ctx.send('Format has to be in NdN±N')
-
+            result = dice.roll(expression, verbose)
+        except dice.DiceError as e:
+            await ctx.send(f'{e}. See `{ctx.prefix}help {ctx.invoked_with}`')
+            return
+
+        # Log and send
+        logger.info('Dice: %s, Result: %s', expression, result)
+        await ctx.send(result)
 
 def setup(bot):
     bot.add_cog(Miscellaneous(bot))
\ No newline at end of file
@@ -1,38 +1,153 @@
+import argparse
 import asyncio
-from collections import deque
+from collections import Counter, deque
 import logging
-from random import shuffle
+import os
+import random
+import statistics
+import time
 
 import discord
-from discord.ext import commands, tasks
-from youtube_dl import YoutubeDL
+from discord.ext import commands
+
+from utils.audiocache import AudioCache
+from utils.audioengine import AudioEngine
+from utils.cache import InfoCache, SearchCache
+from utils.extractor import ExtractorPool, PoolFull
+from utils.journal import Journal
+from utils.loudness import Loudness
+from utils.outbox import CHECK_FAILURE, priority
+from utils.settings import at_least
+from utils.track import Track, TrackQueue
 
 
 # Logger
 logger = logging.getLogger('discord.bot').getChild(__name__)
-logger.setLevel(logging.INFO)
 ydl_logger = logger.getChild('ydl')
 
+# Argument parser
+parser = argparse.ArgumentParser('music')
+parser.add_argument('--info-cache-size', default=1024, type=int, help='Number of cached video infos. Defaults to 1024')
+parser.add_argument('--info-cache-ttl', default=86400.0, type=float, help='Video info cache lifetime in sec. Defaults to 86400')
+parser.add_argument('--info-cache-url-ttl', default=1800.0, type=float, help='Stream URL cache lifetime in sec. Defaults to 1800')
+parser.add_argument('--info-cache-db', default=None, help='Path of an sqlite database persisting the video info cache')
+parser.add_argument('--audio-cache', default=None, help='Directory for caching played songs as Ogg/Opus files')
+parser.add_argument('--audio-cache-size', default=1024, type=int, help='Audio cache size in MiB. Defaults to 1024')
+parser.add_argument('--audio-cache-max-duration', default=900, type=int, help='Longest song in sec saved to the audio cache. Defaults to 900')
+parser.add_argument('--extract-workers', default=4, type=int, help='Number of parallel youtube-dl extractions. Defaults to 4')
+parser.add_argument('--extract-queue', default=100, type=int, help='Number of waiting youtube-dl extractions before rejecting requests. Defaults to 100')
+parser.add_argument('--extract-timeout', default=60.0, type=float, help='youtube-dl extraction timeout in sec. Defaults to 60')
+parser.add_argument('--extract-processes', action='store_true', help='Resolve videos in worker processes instead of threads')
+parser.add_argument('--fast-start', action='store_true', help='Skip most of FFmpeg\'s input probing to start songs sooner')
+parser.add_argument('--state-dir', default=None, help='Directory for persisting queues across restarts and reloads')
+parser.add_argument('--normalize', action='store_true', help='Measure the loudness of queued songs in the background and even it out on playback')
+parser.add_argument('--loudness-workers', default=1, type=int, help='Number of parallel loudness measurements. Defaults to 1')
+parser.add_argument('--loudness-db', default=None, help='Path of an sqlite database persisting measured loudness')
+parser.add_argument('--search-results', default=5, type=int, help='Number of results $search shows. Defaults to 5')
+parser.add_argument('--audio-engine', action='store_true', help='Send the audio of all voice sessions from a few threads on a shared 20 ms tick')
+parser.add_argument('--audio-threads', default=1, type=int, help='Number of audio engine threads. Defaults to 1')
+parser.add_argument('--audio-readers', default=32, type=int, help='Most audio engine threads reading ahead from FFmpeg at once. Defaults to 32')
+parser.add_argument('--search-ttl', default=600.0, type=float, help='Search results cache lifetime in sec, also how long they can be picked from. Defaults to 600')
+args = parser.parse_known_args()
+
 YDL_OPTS = {
     'format': 'bestaudio[acodec=opus]/bestaudio/best',
     'default_search': 'ytsearch',
     'logger': ydl_logger
 }
 
-YDL = YoutubeDL(YDL_OPTS)
+# Seconds a player may stay idle before disconnecting, by default
+IDLE_TIMEOUT = 300.0
+
+# Seconds before the end of a song at which the next one is prefetched
+PREFETCH_LEAD = 15.0
+
+# A song ending this many seconds early is restarted where it stopped, at most STREAM_RESTARTS times
+STREAM_END_TOLERANCE = 5.0
+STREAM_RESTARTS = 3
+
+# Songs per page of $queue
+QUEUE_PAGE = 15
+
+# Playlist entries taken from youtube-dl per worker call
+PLAYLIST_PAGE = 50
+
+# youtube-dl result types holding several entries
+PLAYLIST_TYPES = ('playlist', 'multi_video', 'compat_list')
+
+# Info fields kept in the cache
+INFO_FIELDS = ('id', 'title', 'webpage_url', 'url', 'ext', 'acodec', 'duration', 'filesize', 'tbr', 'asr', 'abr')
+
+def entry_url(entry):
+    """Return a URL resolving a flat playlist entry"""
+    url = entry.get('webpage_url') or entry.get('url')
+    # flat YouTube entries only carry the video id
+    if url and '://' not in url and entry.get('ie_key') == 'Youtube':
+        url = f'https://www.youtube.com/watch?v={url}'
+    return url
 
-# tasks event loop
-loop = asyncio.get_event_loop()
+def format_duration(seconds):
+    """Format seconds as [H:]MM:SS"""
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}:{minutes:02}:{seconds:02}' if hours else f'{minutes}:{seconds:02}'
+
+# youtube-dl calls, run by the extractor pool with the worker's YoutubeDL
+def extract_lazy(ydl, search):
+    """Extract without resolving playlist entries or formats"""
+    ie_result = ydl.extract_info(search, download=False, process=False)
+    while ie_result.get('_type') == 'url':
+        ie_result = ydl.extract_info(ie_result['url'], download=False, ie_key=ie_result.get('ie_key'), process=False)
+    return ie_result
+
+def search_flat(ydl, search, n):
+    """Return the top n results of a YouTube search without resolving them"""
+    ie_result = ydl.extract_info(f'ytsearch{n}:{search}', download=False, process=False)
+    return next_page(ydl, ie_result.get('entries') or (), n)
+
+def resolve(ydl, search, ie_result=None):
+    """Fully resolve a single video"""
+    if ie_result is None:
+        ie_result = extract_lazy(ydl, search)
+
+    # get first item from playlist
+    if ie_result.get('_type') in PLAYLIST_TYPES:
+        ie_result = next(iter(ie_result['entries']))
+
+    return ydl.process_ie_result(ie_result, download=False)
+
+def next_page(_, entries, n):
+    """Return up to n entries from a playlist iterator.
+
+    Pulling from the iterator only issues HTTP requests through the
+    YoutubeDL which extracted the playlist, so any worker may do it.
+    """
+    page = []
+    for entry in entries:
+        page.append(entry)
+        if len(page) == n:
+            break
+    return page
 
 # Checks
+async def check_failed(ctx, name, message):
+    logger.info('Check failed: %s', name)
+    # replies to working commands go first
+    with priority(CHECK_FAILURE):
+        await ctx.send(message)
+
+def guild_player(ctx):
+    """Return the calling guild's player, or None"""
+    return ctx.cog.players.get(ctx.guild.id)
+
 async def bot_voice_connected(ctx):
     success = False
-    if ctx.voice_client:
-        success = ctx.voice_client.is_connected()
+    player = guild_player(ctx)
+    if player and player.vc:
+        success = player.vc.is_connected()
 
     if not success:
-        logger.info('Check failed: bot_voice_connected')
-        await ctx.send('Bot is not connected to a voice channel')
+        await check_failed(ctx, 'bot_voice_connected', 'Bot is not connected to a voice channel')
 
     return success
 
@@ -42,120 +157,651 @@ async def user_voice_connected(ctx):
         success = True
 
     if not success:
-        logger.info('Check failed: user_voice_connected')
-        await ctx.send('You have to be connected to a voice channel')
+        await check_failed(ctx, 'user_voice_connected', 'You have to be connected to a voice channel')
     
     return success
 
 async def playing(ctx):
     success = False
-    if ctx.voice_client:
-        if ctx.voice_client.is_playing():
+    player = guild_player(ctx)
+    if player and player.vc:
+        if player.vc.is_playing():
             success = True
 
     if not success:
-        logger.info('Check failed: playing')
-        await ctx.send('Currently not playing anything')
+        await check_failed(ctx, 'playing', 'Currently not playing anything')
 
     return success
 
 async def paused(ctx):
     success = False
-    if ctx.voice_client:
-        if ctx.voice_client.is_paused():
+    player = guild_player(ctx)
+    if player and player.vc:
+        if player.vc.is_paused():
             success = True
 
     if not success:
-        logger.info('Check failed: voice')
-        await ctx.send('Currently not paused')
+        await check_failed(ctx, 'paused', 'Currently not paused')
 
     return success
 
 
+# Opus source which restarts FFmpeg where it left off when a stream ends early
+# and remembers when it delivered its first packet
+class StreamSource(discord.AudioSource):
+    def __init__(self, url, copy, duration=None, fast_start=False, offset=0.0, gain=None):
+        self.url = url
+        self.copy = copy
+        # in dB, needs transcoding
+        self.gain = gain
+        self.duration = duration
+        self.fast_start = fast_start
+        self.packets = int(offset / 0.02)
+        self.restarts = 0
+        self.on_first_packet = None
+        self.on_restart = None
+        self._source = self._open(offset)
+
+    def _open(self, offset):
+        before_options = []
+        if '://' in self.url:
+            # reconnect dropped connections, turn stalls into errors instead of waiting forever
+            before_options += ['-reconnect 1', '-reconnect_streamed 1', '-reconnect_delay_max 5', '-rw_timeout 15000000']
+        if self.fast_start:
+            before_options += ['-probesize 32768', '-analyzeduration 0']
+        if offset:
+            before_options.append(f'-ss {offset:.2f}')
+        options = f'-af volume={self.gain:.1f}dB' if self.gain else None
+        return discord.FFmpegOpusAudio(self.url, codec='copy' if self.copy else None, before_options=' '.join(before_options), options=options)
+
+    def _ended_early(self):
+        position = self.packets * 0.02
+        return self.duration and self.restarts < STREAM_RESTARTS and position < self.duration - STREAM_END_TOLERANCE
+
+    def is_opus(self):
+        return True
+
+    def read(self):
+        # read() runs in the audio player thread
+        data = self._source.read()
+        while not data and self._ended_early():
+            self.restarts += 1
+            position = self.packets * 0.02
+            logger.warning('Stream ended at %.0fs of %ss, restarting', position, self.duration)
+            self._source.cleanup()
+            self._source = self._open(position)
+            if self.on_restart:
+                self.on_restart()
+            data = self._source.read()
+
+        if data:
+            self.packets += 1
+            if self.on_first_packet:
+                callback, self.on_first_packet = self.on_first_packet, None
+                callback(time.perf_counter())
+        return data
+
+    def cleanup(self):
+        self._source.cleanup()
+
+
+# Per-guild playback state
+class Player:
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.song_queue = TrackQueue()
+        self.vc = None
+        self.channel_id = None
+        self.current_song = None
+        self.started_at = None
+        self.started_wall = None
+        # (track, offset) to resume after a restart
+        self.resume = None
+        self.prefetch_task = None
+        self.prefetch_track = None
+        self.next_source = None
+        self.ingest_task = None
+        # resolving a song right before playing it
+        self.loading = False
+
+    def cancel_ingest(self):
+        """Stop adding playlist entries to the queue"""
+        if self.ingest_task and self.ingest_task is not asyncio.current_task():
+            self.ingest_task.cancel()
+        self.ingest_task = None
+
+    def discard_prefetch(self):
+        """Cancel a pending prefetch and close a prefetched source"""
+        if self.prefetch_task and self.prefetch_task is not asyncio.current_task():
+            self.prefetch_task.cancel()
+        self.prefetch_task = None
+        self.prefetch_track = None
+        if self.next_source:
+            self.next_source[1].cleanup()
+            self.next_source = None
+
+
 class Music(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.song_queue = deque()
-        self.vc = None
+        self.players = {}
+        self.info_cache = InfoCache(args[0].info_cache_size, args[0].info_cache_ttl, args[0].info_cache_url_ttl, args[0].info_cache_db)
+        self.audio_cache = None
+        if args[0].audio_cache:
+            self.audio_cache = AudioCache(args[0].audio_cache, args[0].audio_cache_size * 1024 * 1024)
+        self.search_cache = SearchCache(ttl=args[0].search_ttl)
+        self.loudness = Loudness(args[0].loudness_workers, args[0].loudness_db) if args[0].normalize else None
+        self.extractor = ExtractorPool(YDL_OPTS, ydl_logger.name, args[0].extract_workers, args[0].extract_queue, args[0].extract_timeout, args[0].extract_processes)
+        self.audio_engine = AudioEngine(args[0].audio_threads, args[0].audio_readers) if args[0].audio_engine else None
+        self.cache_tasks = set()
+        # recent inter-track gaps and play to first packet times in ms
+        self.gaps = deque(maxlen=200)
+        self.startups = deque(maxlen=200)
+        self.source_stats = Counter()
+
+        # Per server settings
+        bot.settings.register('idle_timeout', at_least(0.0), IDLE_TIMEOUT, 'Seconds without music before leaving the voice channel')
+        bot.settings.register('queue_limit', at_least(0, int), 0, 'Most songs in the queue, 0 for no limit')
+
+        # Metrics
+        self.extract_seconds = bot.metrics.histogram('music_extract_seconds', 'Time to extract the info of a video, including waiting for a worker')
+        bot.metrics.gauge('music_queued_songs', 'Songs waiting in all queues', func=lambda: sum(len(player.song_queue) for player in self.players.values()))
+        bot.metrics.gauge('music_voice_sessions', 'Connected voice clients', func=lambda: sum(1 for player in self.players.values() if player.vc and player.vc.is_connected()))
+        bot.metrics.gauge('music_extract_pending', 'Extractions waiting for a worker', func=lambda: self.extractor.depth)
+        bot.metrics.gauge('music_loudness', 'Loudness analysis counters', ('stat',), func=lambda: {(k,): v for k, v in self.loudness.stats().items()} if self.loudness else {})
+        bot.metrics.gauge('music_info_cache', 'Video info cache counters', ('stat',), func=lambda: {(k,): v for k, v in self.info_cache.stats().items()})
+        bot.metrics.gauge('music_audio_engine', 'Audio engine counters', ('stat',), func=lambda: {(k,): v for k, v in self.audio_engine.stats().items()} if self.audio_engine else {})
+        bot.metrics.gauge('music_audio_session', 'Frames, underruns and jitter of the current song by guild', ('guild', 'stat'), func=self.session_stats)
+        bot.metrics.gauge('music_search_cache', 'Search results cache counters', ('stat',), func=lambda: {(k,): v for k, v in self.search_cache.stats().items()})
+
+        # Queues survive restarts and reloads
+        self.journal = None
+        self.restore_task = None
+        if args[0].state_dir:
+            self.journal = Journal(os.path.join(args[0].state_dir, 'music.journal'))
+            states = self.replay(self.journal.replay())
+            self.restore_task = bot.loop.create_task(self.restore(states))
 
     def cog_unload(self):
         logger.info('Unload cog')
-        self.auto_disconnect.cancel()
-        self.auto_disconnect.change_interval(seconds=0.0)
-        self.auto_disconnect.start()
+        for name in ('music_queued_songs', 'music_voice_sessions', 'music_extract_pending', 'music_info_cache', 'music_search_cache', 'music_loudness', 'music_audio_engine', 'music_audio_session'):
+            self.bot.metrics.unregister(name)
+        for name in ('idle_timeout', 'queue_limit'):
+            self.bot.settings.unregister(name)
+        # keep the journal as it is, the next load restores from it
+        journal, self.journal = self.journal, None
+        if self.restore_task:
+            self.restore_task.cancel()
+        self.bot.scheduler.cancel_namespace('music.idle')
+        for guild_id in list(self.players):
+            self.bot.loop.create_task(self.free_player(guild_id))
+        for task in self.cache_tasks:
+            task.cancel()
+        self.extractor.close()
+        self.info_cache.close()
+        if self.loudness:
+            self.loudness.close()
+        if self.audio_engine:
+            self.audio_engine.close()
+        if journal:
+            journal.close()
 
-    async def get_info(self, search):
-        logger.info(f'Getting video info for {search}')
-        # extract_info() would block the main code, consequently blocking the discord gateway heartbeat
-        # so we do it in an extra thread
-        ydl_info = await asyncio.to_thread(YDL.extract_info, search, download=False)
+    def session_stats(self):
+        if not self.audio_engine:
+            return {}
+        return {(str(session.client.guild.id), k): v for session in self.audio_engine.sessions() for k, v in session.stats().items()}
 
-        # get first item from playlist
-        if ydl_info.get('_type') == 'playlist':
-            vid = ydl_info['entries'][0]
-        else:
-            vid = ydl_info
+    def persist(self, op, player, **record):
+        """Journal a change of a player's state"""
+        if not self.journal:
+            return
+        self.journal.append(dict(record, op=op, g=player.guild_id))
+        if self.journal.needs_compaction:
+            self.journal.compact(self.snapshot())
+
+    def snapshot(self):
+        """Return journal records describing the state of all players"""
+        records = []
+        for guild_id, player in self.players.items():
+            records.append({'op': 'connect', 'g': guild_id, 'channel': player.channel_id})
+            records.append({'op': 'append', 'g': guild_id, 'tracks': [track.dump() for track in player.song_queue]})
+            if player.current_song:
+                records.append({'op': 'play', 'g': guild_id, 'track': player.current_song.dump(), 'started': player.started_wall})
+        return records
+
+    def replay(self, records):
+        """Rebuild the state of each guild from journal records"""
+        states = {}
+        for record in records:
+            op, guild_id = record['op'], record['g']
+            if op == 'free':
+                states.pop(guild_id, None)
+                continue
+
+            state = states.setdefault(guild_id, {'channel': None, 'queue': TrackQueue(), 'current': None, 'started': None})
+            queue = state['queue']
+            try:
+                if op == 'connect':
+                    state['channel'] = record['channel']
+                elif op == 'append':
+                    queue.extend(Track.load(track) for track in record['tracks'])
+                elif op == 'next':
+                    queue.insert_next(Track.load(record['track']))
+                elif op == 'pop':
+                    queue.popleft()
+                elif op == 'play':
+                    state['current'] = Track.load(record['track']) if record['track'] else None
+                    state['started'] = record.get('started')
+                elif op == 'remove':
+                    queue.remove_at(record['i'])
+                elif op == 'move':
+                    queue.move(record['i'], record['to'])
+                elif op == 'dedupe':
+                    queue.dedupe()
+                elif op == 'shuffle':
+                    queue.shuffle(record['seed'])
+                elif op == 'clear':
+                    queue.clear()
+            except (IndexError, KeyError, TypeError, ValueError):
+                logger.warning('Ignoring inconsistent journal record %s', record)
+        return states
+
+    async def restore(self, states):
+        """Reconnect and resume playback of the replayed guilds"""
+        await self.bot.wait_until_ready()
+        for guild_id, state in states.items():
+            guild = self.bot.get_guild(guild_id)
+            channel = guild.get_channel(state['channel']) if guild and state['channel'] else None
+            if not channel:
+                continue
+
+            # resume the song which was playing where it was
+            queue, current = state['queue'], state['current']
+            resume = None
+            if current and state['started']:
+                offset = time.time() - state['started'] if current.duration else 0.0
+                if not current.duration or offset < current.duration - STREAM_END_TOLERANCE:
+                    queue.insert_next(current)
+                    resume = (current, offset)
+            if not queue:
+                continue
+
+            logger.info('Restoring %s songs in guild id=%s', len(queue), guild_id)
+            try:
+                # the previous instance of the cog may still be disconnecting
+                if guild.voice_client:
+                    await guild.voice_client.disconnect(force=True)
+                vc = await channel.connect()
+            except Exception:
+                logger.exception('Failed to restore player in guild id=%s', guild_id)
+                continue
+
+            player = self.get_player(guild)
+            player.vc, player.channel_id = vc, channel.id
+            player.song_queue, player.resume = queue, resume
+            self.play_song(player)
+
+        # start over from what was actually restored
+        self.journal.compact(self.snapshot())
+        self.restore_task = None
+
+    async def cog_command_error(self, ctx, error):
+        error = getattr(error, 'original', error)
+        if isinstance(error, PoolFull):
+            await ctx.send('Too many songs are being looked up right now. Try again in a moment')
+        elif isinstance(error, asyncio.TimeoutError):
+            await ctx.send('Looking up the song took too long')
+
+    def cog_check(self, ctx):
+        # players are per guild
+        if ctx.guild is None:
+            raise commands.NoPrivateMessage()
+        return True
+
+    def get_player(self, guild):
+        """Return the guild's player, creating it if necessary"""
+        player = self.players.get(guild.id)
+        if player is None:
+            logger.info('Creating player for guild id=%s', guild.id)
+            player = self.players[guild.id] = Player(guild.id)
+        return player
+
+    async def free_player(self, guild_id):
+        """Disconnect and forget a guild's player"""
+        player = self.players.pop(guild_id, None)
+        if player is None:
+            return
+
+        logger.info('Freeing player for guild id=%s', guild_id)
+        self.persist('free', player)
+        self.bot.scheduler.cancel(('music.idle', guild_id))
+        player.discard_prefetch()
+        player.cancel_ingest()
+        player.song_queue.clear()
+        vc, player.vc = player.vc, None
+        if vc and vc.is_connected():
+            await vc.disconnect()
+
+    async def extract_info(self, search, ie_result=None, guild_id=None):
+        logger.info('Getting video info for %s', search)
+        # extract_info() would block the main code, consequently blocking the discord gateway heartbeat
+        # so we do it in the extractor pool
+        with self.extract_seconds.time():
+            vid = await self.extractor.run(resolve, search, ie_result, key=guild_id, process=True)
 
         # log video info
-        logger.info('youtube-dl info:')
-        logger.info(f"\next: {vid['ext']}\nfilesize: {vid['filesize']}\ntbr: {vid['tbr']}\nacodec: {vid['acodec']}\nasr: {vid['asr']}\nabr: {vid['abr']}")
+        logger.debug('youtube-dl info:\next: %s\nfilesize: %s\ntbr: %s\nacodec: %s\nasr: %s\nabr: %s', vid.get('ext'), vid.get('filesize'), vid.get('tbr'), vid.get('acodec'), vid.get('asr'), vid.get('abr'))
+
+        # only keep what we need
+        return {field: vid.get(field) for field in INFO_FIELDS}
+
+    async def get_info(self, search, guild_id=None, ie_result=None):
+        return await self.info_cache.fetch(search, lambda query: self.extract_info(query, ie_result if query == search else None, guild_id))
+
+    async def get_infos(self, search, guild_id=None):
+        """Return the first video for `search` and an iterator of the remaining playlist entries, if any"""
+        # searches and cached videos only ever give one video
+        if '://' not in search or self.info_cache.cached(search):
+            return await self.get_info(search, guild_id), None
+
+        ie_result = await self.extractor.run(extract_lazy, search, key=guild_id)
+        if ie_result.get('_type') not in PLAYLIST_TYPES:
+            return await self.get_info(search, guild_id, ie_result), None
+
+        # entries is often a generator fetching further pages on demand
+        logger.info('Lazily reading playlist %s', ie_result.get("title"))
+        entries = iter(ie_result['entries'])
+        while True:
+            page = await self.extractor.run(next_page, entries, 1, key=guild_id)
+            if not page:
+                raise commands.BadArgument('Playlist is empty')
+            try:
+                return await self.get_info(entry_url(page[0]), guild_id), entries
+            except PoolFull:
+                raise
+            except Exception:
+                logger.exception('Skipping playlist entry %s', page[0].get("title"))
+
+    async def search_results(self, search, guild_id=None):
+        """Return the top search results as dicts of title, webpage_url and duration"""
+        async def extract(query):
+            logger.info('Searching for %s', query)
+            with self.extract_seconds.time():
+                entries = await self.extractor.run(search_flat, query, args[0].search_results, key=guild_id)
+            return [{'title': entry.get('title') or entry_url(entry), 'webpage_url': entry_url(entry), 'duration': entry.get('duration')} for entry in entries if entry_url(entry)]
+        return await self.search_cache.fetch(search, extract)
+
+    async def ingest(self, player, entries, requester_id):
+        """Move playlist entries into the queue page by page"""
+        count = 0
+        while True:
+            # pulling from the generator may download the next page
+            try:
+                page = await self.extractor.run(next_page, entries, PLAYLIST_PAGE, key=player.guild_id)
+            except Exception:
+                logger.exception('Failed to read further playlist entries')
+                break
+            if not page:
+                break
+
+            # entries are only fully resolved right before they play
+            tracks = []
+            for entry in page:
+                url = entry_url(entry)
+                if url:
+                    tracks.append(Track(entry.get('title') or url, url, duration=entry.get('duration'), requester_id=requester_id))
+            room = await self.queue_room(player)
+            full = room is not None and room <= len(tracks)
+            if full:
+                tracks = tracks[:room]
+            self.enqueue(player, tracks)
+            count += len(tracks)
+            if full:
+                logger.info('Queue of guild id=%s is full', player.guild_id)
+                break
+
+        logger.info('Queued %s further playlist entries', count)
+        player.ingest_task = None
 
-        return vid
+    async def queue_room(self, player):
+        """Return how many more songs fit into the queue, None without a limit"""
+        limit = await self.bot.settings.get(player.guild_id, 'queue_limit')
+        return max(0, limit - len(player.song_queue)) if limit else None
 
-    def create_source(self, vid):
+    def enqueue(self, player, tracks):
+        """Append tracks to a player's queue"""
+        player.song_queue.extend(tracks)
+        self.persist('append', player, tracks=[track.dump() for track in tracks])
+        self.queue_changed(player)
+
+    def queue_changed(self, player):
+        """Redo the prefetch if the head of the queue changed"""
+        head = player.song_queue[0] if player.song_queue else None
+        if head is not player.prefetch_track and player.vc and (player.vc.is_playing() or player.vc.is_paused()):
+            self.schedule_prefetch(player)
+
+    def cached_file(self, track):
+        """Return the audio cache file of a track, or None"""
+        if self.audio_cache:
+            return self.audio_cache.lookup(track.webpage_url)
+        return None
+
+    def save_to_cache(self, track):
+        """Save a track to the audio cache in the background"""
+        if not self.audio_cache or not track.url or not track.duration or track.duration > args[0].audio_cache_max_duration:
+            return
+        task = self.bot.loop.create_task(self.audio_cache.store(track.webpage_url, track.url, track.acodec))
+        self.cache_tasks.add(task)
+        task.add_done_callback(self.cache_tasks.discard)
+
+    def analyze(self, track, path=None):
+        """Measure the loudness of a track in the background, for when it plays"""
+        if self.loudness and (path or track.url):
+            self.loudness.analyze(track.webpage_url, path or track.url)
+
+    def create_source(self, track, path=None, offset=0.0):
         # create audio source
         logger.info('Creating audio source')
-        if vid['acodec'] == 'opus':
-            source = discord.FFmpegOpusAudio(vid['url'], codec='copy')
+        # only what was measured already, playback never waits for it
+        gain = self.loudness.gain(track.webpage_url) if self.loudness else None
+        if gain:
+            self.source_stats['normalized'] += 1
+            source = StreamSource(path or track.url, False, track.duration, args[0].fast_start and not path, offset, gain)
+        elif path:
+            # cached files are always Ogg/Opus
+            self.source_stats['cached'] += 1
+            source = StreamSource(path, True, track.duration, offset=offset)
+        elif (track.acodec or '').lower() == 'opus':
+            # Opus in webm/ogg only needs remuxing
+            self.source_stats['copy'] += 1
+            source = StreamSource(track.url, True, track.duration, args[0].fast_start, offset)
         else:
-            source = discord.FFmpegOpusAudio(vid['url'])
+            self.source_stats['transcode'] += 1
+            source = StreamSource(track.url, False, track.duration, args[0].fast_start, offset)
+        self.analyze(track, path)
 
+        # restarts happen in the audio player thread
+        source.on_restart = lambda: self.bot.loop.call_soon_threadsafe(self.source_stats.update, ('restart',))
         return source
 
-    def play_song(self, _):
+    def schedule_prefetch(self, player):
+        """Prefetch the head of the queue shortly before the current song ends"""
+        player.discard_prefetch()
+        if not player.song_queue or not player.current_song or not player.current_song.duration:
+            return
+
+        remaining = player.started_at + player.current_song.duration - self.bot.loop.time()
+        player.prefetch_track = player.song_queue[0]
+        player.prefetch_task = self.bot.loop.create_task(self.prefetch(player, max(0.0, remaining - PREFETCH_LEAD)))
+
+    async def prefetch(self, player, delay):
+        await asyncio.sleep(delay)
+        track = player.prefetch_track
+        logger.info('Prefetching "%s"', track.title)
+        path = self.cached_file(track)
+        try:
+            # the stream URL resolved at enqueue time may have expired by now
+            if not path:
+                track.update(await self.get_info(track.webpage_url, player.guild_id))
+        except Exception:
+            logger.exception('Failed to prefetch "%s"', track.title)
+            return
+
+        # starting FFmpeg early lets it connect and buffer before the handover
+        if player.vc and player.song_queue and player.song_queue[0] is track:
+            player.next_source = (track, self.create_source(track, path))
+        player.prefetch_task = None
+
+    def record_first_packet(self, started, finished, first_packet):
+        startup = (first_packet - started) * 1000
+        self.startups.append(startup)
+        logger.info('Time to first packet: %.0f ms', startup)
+        if finished:
+            gap = (first_packet - finished) * 1000
+            self.gaps.append(gap)
+            logger.info('Inter-track gap: %.0f ms', gap)
+
+    def song_finished(self, player):
+        # "after" is called from the audio player thread, continue on the event loop
+        def after(_):
+            finished = time.perf_counter()
+            self.bot.loop.call_soon_threadsafe(self.play_song, player, finished)
+        return after
+
+    def play_song(self, player, finished=None):
         # check if we are connected
         # "after" call even triggers after the bot has already disconnected
-        if not self.vc:
+        if not player.vc:
             return
-        elif not self.vc.is_connected():
+        elif not player.vc.is_connected():
             return
 
-        if len(self.song_queue) == 0:
-            # start auto disconnect task
-            logger.info('Start auto_disconnect timer')
-            self.auto_disconnect.start()
+        if len(player.song_queue) == 0:
+            # start auto disconnect timer
+            self.bot.loop.create_task(self.schedule_idle(player))
+            if player.current_song:
+                player.current_song = None
+                self.persist('play', player, track=None)
             return
 
         # cancel auto_disconnect if running
-        self.auto_disconnect.cancel()
+        self.bot.scheduler.cancel(('music.idle', player.guild_id))
 
         # Get next song
-        vid = self.song_queue.popleft()
-        logger.info(f'Getting "{vid["title"]}" from queue')
+        track = player.song_queue.popleft()
+        self.persist('pop', player)
+        logger.info('Getting "%s" from queue', track.title)
 
-        source = self.create_source(vid)
+        # resuming after a restart
+        offset = 0.0
+        if player.resume:
+            if player.resume[0] is track:
+                offset = player.resume[1]
+            player.resume = None
 
-        logger.info(f"Playing song {vid['title']}")
-        self.vc.play(source, after=self.play_song)
-        self.current_song = vid
+        # use the prefetched source if it is still for this song
+        if player.next_source and player.next_source[0] is track:
+            source = player.next_source[1]
+            player.next_source = None
+        else:
+            path = self.cached_file(track)
+            if not path and track.url is None:
+                # playlist entry which hasn't been resolved yet
+                player.discard_prefetch()
+                player.loading = True
+                self.bot.loop.create_task(self.resolve_and_play(player, track, finished, offset))
+                return
+            source = self.create_source(track, path, offset)
+        player.discard_prefetch()
+        self.start_song(player, track, source, finished, offset)
+        self.save_to_cache(track)
 
+    async def resolve_and_play(self, player, track, finished, offset=0.0):
+        try:
+            track.update(await self.get_info(track.webpage_url, player.guild_id))
+            source = self.create_source(track, offset=offset)
+        except Exception:
+            logger.exception('Failed to resolve "%s", skipping', track.title)
+            source = None
+        finally:
+            player.loading = False
 
-    # Tasks
-    @tasks.loop(minutes=5.0, count=2, loop=loop)
-    async def auto_disconnect(self):
-        # only run on second loop
-        if self.auto_disconnect.current_loop > 0:
-            logger.info('Auto-Disconnect')
-            if self.vc:
-                await self.vc.disconnect()
+        if not (player.vc and player.vc.is_connected()):
+            return
+        if source:
+            self.start_song(player, track, source, finished, offset)
+            self.save_to_cache(track)
+        else:
+            self.play_song(player, finished)
+
+    def start_song(self, player, track, source, finished=None, offset=0.0):
+        started = time.perf_counter()
+        source.on_first_packet = lambda first_packet: self.record_first_packet(started, finished, first_packet)
+
+        logger.info('Playing song %s', track.title)
+        if self.audio_engine:
+            self.audio_engine.play(player.vc, source, after=self.song_finished(player))
+        else:
+            player.vc.play(source, after=self.song_finished(player))
+        player.current_song = track
+        player.started_at = self.bot.loop.time() - offset
+        player.started_wall = time.time() - offset
+        self.persist('play', player, track=track.dump(), started=player.started_wall)
+        self.schedule_prefetch(player)
+
+
+    # Idle timer
+    async def schedule_idle(self, player):
+        timeout = await self.bot.settings.get(player.guild_id, 'idle_timeout')
+        # a song may have been queued while the setting was read
+        if self.players.get(player.guild_id) is not player or player.song_queue or player.current_song or player.loading:
+            return
+        logger.info('Start auto_disconnect timer for guild id=%s', player.guild_id)
+        self.bot.scheduler.schedule(('music.idle', player.guild_id), timeout, self.auto_disconnect, player)
+
+    async def auto_disconnect(self, player):
+        logger.info('Auto-Disconnect guild id=%s', player.guild_id)
+        if self.players.get(player.guild_id) is player:
+            await self.free_player(player.guild_id)
+
+    # Forget players whose voice connection went away
+    @commands.Cog.listener()
+    async def on_voice_state_update(self, member, before, after):
+        if member.id == self.bot.user.id and before.channel and not after.channel:
+            player = self.players.get(member.guild.id)
+            if player and not (player.vc and player.vc.is_connected()):
+                await self.free_player(member.guild.id)
 
     # Commands
+    @commands.command(name='musicstats', hidden=True)
+    @commands.is_owner()
+    async def music_stats(self, ctx):
+        stats = {f'cache {k}': v for k, v in self.info_cache.stats().items()}
+        stats.update((f'search cache {k}', v) for k, v in self.search_cache.stats().items())
+        if self.audio_cache:
+            stats.update((f'audio cache {k}', v) for k, v in self.audio_cache.stats().items())
+        stats.update((f'extract {k}', v) for k, v in self.extractor.stats().items())
+        stats['players'] = len(self.players)
+        if self.audio_engine:
+            stats.update((f'audio {k}', v) for k, v in self.audio_engine.stats().items())
+        stats.update((f'sources {k}', v) for k, v in self.source_stats.items())
+        if self.startups:
+            stats['first packet p50 ms'] = round(statistics.median(self.startups))
+            stats['first packet max ms'] = round(max(self.startups))
+        if self.gaps:
+            stats['gap p50 ms'] = round(statistics.median(self.gaps))
+            stats['gap max ms'] = round(max(self.gaps))
+        await ctx.send(', '.join(f'{k}: {v}' for k, v in stats.items()))
+
     @commands.command(brief='Connect to a voice channel')
     @commands.check(user_voice_connected)
     async def connect(self, ctx):
+        player = self.get_player(ctx.guild)
         voice_channel = ctx.author.voice.channel
-        logger.info(f'Connecting to voice channel: "{voice_channel}" id={voice_channel.id}')
-        self.vc = await voice_channel.connect()
+        logger.info('Connecting to voice channel: "%s" id=%s', voice_channel, voice_channel.id)
+        player.vc = await voice_channel.connect()
+        player.channel_id = voice_channel.id
+        self.persist('connect', player, channel=voice_channel.id)
 
         # react if called directly
         if ctx.invoked_with == self.connect.name:
@@ -167,60 +813,186 @@ class Music(commands.Cog):
             # Stop playback & empty queue
             await ctx.invoke(self.stop)
 
-            voice_channel = self.vc.channel
-            logger.info(f'Disconnecting from voice channel: "{voice_channel}" id={voice_channel.id}')
-            await self.vc.disconnect()
-            self.vc = None
+            voice_channel = guild_player(ctx).vc.channel
+            logger.info('Disconnecting from voice channel: "%s" id=%s', voice_channel, voice_channel.id)
+            await self.free_player(ctx.guild.id)
             # add reaction if invoked directly
             if ctx.invoked_with == self.stop.name:
                 await ctx.message.add_reaction('👋')
 
-    @commands.command(brief='Play/Queue a song')
-    @commands.check(user_voice_connected)
-    async def play(self, ctx, *, search):
+    async def join_player(self, ctx):
+        """Return the connected player of the guild, None if its queue is full"""
+        player = self.get_player(ctx.guild)
+        if await self.queue_room(player) == 0:
+            await ctx.send(f'The queue is full, it holds at most {await self.bot.settings.get(ctx.guild.id, "queue_limit")} songs')
+            return None
+
         # Connect to channel if not connected
-        if not self.vc:
+        if not player.vc:
             logger.info('Not connect to voice. Connecting now')
             await ctx.invoke(self.connect)
+        return player
+
+    def add_track(self, player, track, play_next=False):
+        logger.info('Putting "%s" into queue', track.title)
+        self.analyze(track, self.cached_file(track))
+        if play_next:
+            player.song_queue.insert_next(track)
+            self.persist('next', player, track=track.dump())
+            self.queue_changed(player)
+        else:
+            self.enqueue(player, [track])
+
+    async def queue_search(self, ctx, search, play_next=False):
+        player = await self.join_player(ctx)
+        if not player:
+            return
 
         async with ctx.typing():
-            vid = await self.get_info(search)
-            vid['requester'] = ctx.author
-            logger.info(f'Putting "{vid["title"]}" into queue')
-            self.song_queue.append(vid)
+            vid, entries = await self.get_infos(search, ctx.guild.id)
+            track = Track.from_info(vid, ctx.author.id)
+            self.add_track(player, track, play_next)
 
+        # the rest of a playlist streams into the queue in the background
+        if entries:
+            player.cancel_ingest()
+            player.ingest_task = self.bot.loop.create_task(self.ingest(player, entries, ctx.author.id))
+        await self.announce(ctx, player, track, entries)
+
+    async def announce(self, ctx, player, track, entries=None):
         # Start playing audio if not playing already
-        if self.vc.is_playing():
-            embed = discord.Embed(title="", description=f"Queueing [{vid['title']}]({vid['webpage_url']}) [{ctx.author.mention}]", color=discord.Color.blue())
+        if player.vc.is_playing() or player.vc.is_paused() or player.loading:
+            embed = discord.Embed(title="", description=f"Queueing [{track.title}]({track.webpage_url}) [{ctx.author.mention}]", color=discord.Color.blue())
         else:
-            self.play_song(None)
-            embed = discord.Embed(title="", description=f"Playing [{vid['title']}]({vid['webpage_url']}) [{ctx.author.mention}]", color=discord.Color.green())
+            self.play_song(player)
+            embed = discord.Embed(title="", description=f"Playing [{track.title}]({track.webpage_url}) [{ctx.author.mention}]", color=discord.Color.green())
+        if entries:
+            embed.description += '\nQueueing the rest of the playlist'
 
-        # respond
-        await ctx.message.add_reaction('▶')
+        # respond, the reply takes the place of the reaction while the channel is backed up
+        reaction = self.bot.loop.create_task(ctx.message.add_reaction('▶'))
         await ctx.send(embed=embed)
+        await reaction
+
+    @commands.command(brief='Play/Queue a song or playlist')
+    @commands.check(user_voice_connected)
+    async def play(self, ctx, *, search):
+        await self.queue_search(ctx, search)
+
+    @commands.command(name='playnext', brief='Queue a song to play next')
+    @commands.check(user_voice_connected)
+    async def play_next(self, ctx, *, search):
+        await self.queue_search(ctx, search, play_next=True)
+
+    @commands.command(brief='Search for songs to pick from', usage='query')
+    async def search(self, ctx, *, search):
+        async with ctx.typing():
+            results = await self.search_results(search, ctx.guild.id)
+        if not results:
+            await ctx.send('Nothing found')
+            return
+        # picked from by the same user in the same channel
+        self.search_cache.show((ctx.channel.id, ctx.author.id), results)
+
+        lines = []
+        for number, result in enumerate(results, 1):
+            duration = f' ({format_duration(result["duration"])})' if result['duration'] else ''
+            lines.append(f'{number}. [{result["title"][:100]}]({result["webpage_url"]}){duration}')
+        embed = discord.Embed(title='Search results', description='\n'.join(lines), color=discord.Colour.blue())
+        embed.set_footer(text=f'Pick one with {ctx.prefix}pick <number>')
+        await ctx.send(embed=embed)
+
+    @commands.command(brief='Queue a song from your last search', usage='number')
+    @commands.check(user_voice_connected)
+    async def pick(self, ctx, number: int):
+        results = self.search_cache.shown((ctx.channel.id, ctx.author.id))
+        if not results:
+            await ctx.send(f'No recent search results, use {ctx.prefix}search first')
+            return
+        if not 1 <= number <= len(results):
+            await ctx.send(f'Pick a number from 1 to {len(results)}')
+            return
+        player = await self.join_player(ctx)
+        if not player:
+            return
 
-    @commands.command(brief='Display current queue')
+        # resolved right before it plays, like playlist entries
+        result = results[number - 1]
+        track = Track(result['title'], result['webpage_url'], duration=result['duration'], requester_id=ctx.author.id)
+        self.add_track(player, track)
+        await self.announce(ctx, player, track)
+
+    @commands.command(brief='Display current queue', usage='[page]')
     @commands.check(playing)
-    async def queue(self, ctx):
-        embed = discord.Embed(title='Queue', description=f"**Current song:** [{self.current_song['title']}]({self.current_song['webpage_url']}) [{self.current_song['requester'].mention}]", color=discord.Colour.blue())
-        song_number = 0
-
-        # add songs
-        for song in self.song_queue:
-            song_number += 1
-            if len(embed.description) < 4096:
-                embed.description += f"\n{song_number}. [{song['title']}]({song['webpage_url']}) [{song['requester'].mention}]"
-            else:
-                break
+    async def queue(self, ctx, page: int = 1):
+        player = guild_player(ctx)
+        song_queue = player.song_queue
+        pages = song_queue.pages(QUEUE_PAGE)
+        page = max(1, min(page, pages))
 
+        # only render the requested page
+        lines = [f"**Current song:** [{player.current_song.title}]({player.current_song.webpage_url}) [{player.current_song.requester_mention}]"]
+        first = (page - 1) * QUEUE_PAGE + 1
+        for song_number, song in enumerate(song_queue.page(page - 1, QUEUE_PAGE), first):
+            lines.append(f"{song_number}. [{song.title[:100]}]({song.webpage_url}) [{song.requester_mention}]")
+
+        embed = discord.Embed(title='Queue', description='\n'.join(lines), color=discord.Colour.blue())
+        embed.set_footer(text=f'Page {page}/{pages} | {len(song_queue)} songs | {format_duration(song_queue.duration)}')
         await ctx.send(embed=embed)
 
+    @commands.command(brief='Remove a song from the queue', usage='number')
+    @commands.check(playing)
+    async def remove(self, ctx, number: int):
+        player = guild_player(ctx)
+        try:
+            track = player.song_queue.remove_at(number - 1) if number > 0 else None
+        except IndexError:
+            track = None
+        if not track:
+            await ctx.send(f'There is no song {number} in the queue')
+            return
+
+        logger.info('Removed "%s" from queue', track.title)
+        self.persist('remove', player, i=number - 1)
+        self.queue_changed(player)
+        await ctx.message.add_reaction('✅')
+
+    @commands.command(brief='Move a song in the queue', usage='number position')
+    @commands.check(playing)
+    async def move(self, ctx, number: int, position: int):
+        player = guild_player(ctx)
+        try:
+            track = player.song_queue.move(number - 1, position - 1) if number > 0 else None
+        except IndexError:
+            track = None
+        if not track:
+            await ctx.send(f'There is no song {number} in the queue')
+            return
+
+        logger.info('Moved "%s" to position %s', track.title, position)
+        self.persist('move', player, i=number - 1, to=position - 1)
+        self.queue_changed(player)
+        await ctx.message.add_reaction('✅')
+
+    @commands.command(brief='Remove duplicate songs from the queue')
+    @commands.check(playing)
+    async def dedupe(self, ctx):
+        player = guild_player(ctx)
+        removed = player.song_queue.dedupe()
+        logger.info('Removed %s duplicate songs from queue', removed)
+        self.persist('dedupe', player)
+        self.queue_changed(player)
+        await ctx.send(f'Removed {removed} duplicate songs')
+
     @commands.command(brief='Clear song queue')
     @commands.check(playing)
     async def clear(self, ctx):
         logger.info('Clear song queue')
-        self.song_queue = deque()
+        player = guild_player(ctx)
+        player.song_queue.clear()
+        self.persist('clear', player)
+        player.discard_prefetch()
+        player.cancel_ingest()
 
         await ctx.message.add_reaction('✅')
 
@@ -228,38 +1000,47 @@ class Music(commands.Cog):
     @commands.check(playing)
     async def skip(self, ctx):
         logger.info('Skipping current song')
-        self.vc.stop()
+        guild_player(ctx).vc.stop()
         await ctx.message.add_reaction('⏭')
 
     @commands.command(brief='Shuffle queue')
     @commands.check(playing)
     async def shuffle(self, ctx):
         logger.info('Shuffling queue')
-        shuffle(self.song_queue)
+        player = guild_player(ctx)
+        seed = random.getrandbits(32)
+        player.song_queue.shuffle(seed)
+        self.persist('shuffle', player, seed=seed)
+        self.queue_changed(player)
         await ctx.message.add_reaction('🔀')
 
     @commands.command(brief='Pause current playback')
     @commands.check(playing)
     async def pause(self, ctx):
         logger.info('Pausing playback')
-        self.vc.pause()
+        guild_player(ctx).vc.pause()
         await ctx.message.add_reaction('⏸')
 
     @commands.command(brief='Resume playback')
     @commands.check(paused)
     async def resume(self, ctx):
         logger.info('Resuming playback')
-        self.vc.resume()
+        guild_player(ctx).vc.resume()
         await ctx.message.add_reaction('▶')
 
     @commands.command(brief='Stop current playback and empty queue')
     @commands.check_any(commands.check(playing), commands.check(paused))
     async def stop(self, ctx):
+        player = guild_player(ctx)
+
         # Empty queue
-        self.song_queue = deque()
+        player.song_queue.clear()
+        self.persist('clear', player)
+        player.discard_prefetch()
+        player.cancel_ingest()
 
         logger.info('Stopping playback')
-        self.vc.stop()
+        player.vc.stop()
 
         # react if called directly
         if ctx.invoked_with == self.stop.name:
@@ -1,118 +1,259 @@
 import argparse
 import logging
+import os
 import random
 from typing import KeysView
 
-from discord.ext import commands, tasks
+from discord.ext import commands
+
+from utils.journal import Journal
+from utils.settings import at_least
 
 # Logger
 logger = logging.getLogger('discord.bot').getChild(__name__)
 
 # Argument parser
 parser = argparse.ArgumentParser('totpal')
-parser.add_argument('-r', '--reset', default=7200.0, type=float, help='Game reset timer in sec. Defaults to 7200')
+parser.add_argument('-r', '--reset', default=7200.0, type=float, help='Reset a game after this many seconds without commands in it, unless a server sets its own. Defaults to 7200')
+parser.add_argument('--state-dir', default=None, help='Directory for persisting games across restarts and reloads')
 args = parser.parse_known_args()
 
 # Totpal Game class
 class Game:
     def __init__(self):
-        self.d = {}
+        # players and articles in parallel lists, index maps a player to its position
+        self._players = []
+        self._articles = []
+        self._index = {}
+
+    def __contains__(self, user):
+        return user in self._index
 
     def add(self, user, article):
         """Add/update a player's article"""
-        logger.info(f'Set Article: {user}: {article}')
-        self.d[user] = article
+        logger.info('Set Article: %s: %s', user, article)
+        i = self._index.get(user)
+        if i is None:
+            self._index[user] = len(self._players)
+            self._players.append(user)
+            self._articles.append(article)
+        else:
+            self._articles[i] = article
 
     def remove(self, user):
         """Remove a player from the game"""
-        logger.info(f'Remove player: {user}')
-        del self.d[user]
+        logger.info('Remove player: %s', user)
+        i = self._index.pop(user)
+        # move the last player into the gap
+        last_user, last_article = self._players.pop(), self._articles.pop()
+        if i < len(self._players):
+            self._players[i], self._articles[i] = last_user, last_article
+            self._index[last_user] = i
 
     def my(self, user):
         """Show a players article"""
-        return self.d[user]
+        return self._articles[self._index[user]]
 
     def random(self, user):
-        """Return a random article"""
-        r = random.choice(list(self.d.items()))
-        if r[0] != user:
-            logger.info(f'Random article: {r[1]}')
-            return r[1]
+        """Return a random article, which is not the user's"""
+        i = self._index.get(user)
+        if i is None:
+            r = random.randrange(len(self._players))
         else:
-            return self.random(user)
+            # pick among everyone else by skipping over the user's position
+            r = random.randrange(len(self._players) - 1)
+            if r >= i:
+                r += 1
+        logger.info('Random article: %s', self._articles[r])
+        return self._articles[r]
 
-    def reset(self, auto=False):
-        """Reset the game"""
-        if auto:
-            logger.info(f'Game automaticlly reset after {args[0].reset} seconds')
+    def reset(self, after=None):
+        """Reset the game, `after` seconds without commands if automatic"""
+        if after:
+            logger.info('Game automaticlly reset after %s seconds', after)
         else:
             logger.info('Game manually reset')
-        self.d = {}
+        self._players = []
+        self._articles = []
+        self._index = {}
+
+    def items(self):
+        """Return (player, article) pairs"""
+        return zip(self._players, self._articles)
 
     def players(self) -> KeysView:
         """Return players"""
-        return self.d.keys()
+        return self._index.keys()
 
     def number_of_players(self):
         """Return the number of players"""
-        return len(self.players())
+        return len(self._players)
 
 # Totpal game commands
 class Totpal(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
 
-        # Initialize game
-        self.g = Game()
-        logger.info('Game initialized')
+        # Games per channel, (guild id, channel id) -> Game
+        self.sessions = {}
+        # The game a user's private messages refer to, user id -> (guild id, channel id)
+        self.joined = {}
+        bot.settings.register('totpal_reset', at_least(60.0), args[0].reset, 'Seconds without commands before a Totpal game resets')
+        bot.metrics.gauge('totpal_games', 'Games with at least one player', func=lambda: sum(1 for game in self.sessions.values() if game.number_of_players()))
+
+        # Articles survive restarts and reloads
+        self.journal = None
+        self.restore_task = None
+        if args[0].state_dir:
+            self.journal = Journal(os.path.join(args[0].state_dir, 'totpal.journal'))
+            self.restore_task = bot.loop.create_task(self.restore(self.journal.replay()))
 
     def cog_unload(self):
-        self.reset_timer.cancel()
+        self.bot.metrics.unregister('totpal_games')
+        self.bot.settings.unregister('totpal_reset')
+        self.bot.scheduler.cancel_namespace('totpal.reset')
+        if self.restore_task:
+            self.restore_task.cancel()
+        if self.journal:
+            self.journal.close()
+
+    def session(self, ctx, create=False):
+        """Return key and game of the context's channel. In private messages the game the user joined"""
+        if ctx.guild:
+            key = (ctx.guild.id, ctx.channel.id)
+        else:
+            key = self.joined.get(ctx.author.id)
+            if key is None:
+                return None, None
+
+        game = self.sessions.get(key)
+        if game is None and create:
+            logger.info('Game initialized for guild id=%s channel id=%s', key[0], key[1])
+            game = self.sessions[key] = Game()
+        return key, game
+
+    def persist(self, record):
+        """Journal a change of the game"""
+        if not self.journal:
+            return
+        self.journal.append(record)
+        if self.journal.needs_compaction:
+            self.journal.compact(self.snapshot())
+
+    def snapshot(self):
+        """Return journal records describing all games"""
+        records = [{'op': 'join', 'user': user_id, 's': key} for user_id, key in self.joined.items()]
+        for key, game in self.sessions.items():
+            records.extend({'op': 'set', 's': key, 'user': user.id, 'article': article} for user, article in game.items())
+        return records
+
+    async def restore(self, records):
+        """Restore the games of a previous run"""
+        # (guild id, channel id) -> user id -> article
+        sessions = {}
+        joined = {}
+        for record in records:
+            op = record['op']
+            key = tuple(record['s']) if record.get('s') else None
+            if op == 'join':
+                joined[record['user']] = key
+            elif op == 'set':
+                sessions.setdefault(key, {})[record['user']] = record['article']
+            elif op == 'remove':
+                sessions.get(key, {}).pop(record['user'], None)
+            elif op == 'reset':
+                if key:
+                    sessions.pop(key, None)
+                else:
+                    sessions.clear()
+
+        await self.bot.wait_until_ready()
+        # don't overwrite what happened since startup
+        for user_id, key in joined.items():
+            self.joined.setdefault(user_id, key)
+        users = {}
+        for key, articles in sessions.items():
+            game = self.sessions.setdefault(key, Game())
+            for user_id, article in articles.items():
+                try:
+                    if user_id not in users:
+                        users[user_id] = self.bot.get_user(user_id) or await self.bot.fetch_user(user_id)
+                except Exception:
+                    logger.exception('Failed to restore article of user id=%s', user_id)
+                    continue
+                if users[user_id] not in game:
+                    game.add(users[user_id], article)
+            if ('totpal.reset', key) not in self.bot.scheduler:
+                await self.schedule_reset(key)
+
+        logger.info('Restored %s games', len(sessions))
+        self.journal.compact(self.snapshot())
+        self.restore_task = None
 
     # Automatic reset
     @commands.Cog.listener()
     async def on_command(self, ctx):
         if ctx.command.cog_name == self.qualified_name: # only trigger when command is from current cog
-            logger.info(f'Starting new reset timer lasting {args[0].reset} seconds')
-            if self.reset_timer.is_running():
-                logger.debug('Restart reset timer')
-                self.reset_timer.restart()
-            else:
-                logger.debug('Start reset timer')
-                self.reset_timer.start()
-
-    # Reset timer
-    @tasks.loop(seconds=args[0].reset, count=2)
-    async def reset_timer(self):
-        logger.debug(f'Reset task fired. Current iteration {self.reset_timer.current_loop}')
-        if self.reset_timer.current_loop > 0:
-            self.g.reset(auto=True)
+            key, _ = self.session(ctx)
+            if key:
+                await self.schedule_reset(key)
+
+    async def schedule_reset(self, key):
+        """Reset a game after it has been unused for the reset interval"""
+        interval = await self.bot.settings.get(key[0], 'totpal_reset')
+        logger.debug('Reset game of channel id=%s in %s seconds', key[1], interval)
+        self.bot.scheduler.schedule(('totpal.reset', key), interval, self.auto_reset, key, interval)
+
+    # Reset timer fired
+    def auto_reset(self, key, interval):
+        game = self.sessions.pop(key, None)
+        if game:
+            game.reset(after=interval)
+            self.persist({'op': 'reset', 's': key})
+
+    # Join the game of a channel
+    @commands.command(brief='Join the game in this channel')
+    @commands.guild_only()
+    async def join(self, ctx):
+        key, _ = self.session(ctx, create=True)
+        self.joined[ctx.author.id] = key
+        self.persist({'op': 'join', 'user': ctx.author.id, 's': key})
+        await ctx.send(f'{ctx.author.display_name} joined the game. Send me your article in a private message using `{ctx.prefix}set`')
 
     # Set article
     @commands.command(name='set', aliases=['SetMyArticle', 'sma', 'SetArticle', 'sa',], brief='Set your article', usage='Name of Article')
     @commands.dm_only()
     async def set_article(self, ctx, *args):
+        key, game = self.session(ctx, create=True)
         if args == ():
             await ctx.send('Need to supply an article')
+        elif game is None:
+            await ctx.send(f'Join a game first using `{ctx.prefix}join` in its channel')
         else:
             article = ' '.join(args)
-            self.g.add(ctx.author, article)
+            game.add(ctx.author, article)
+            self.persist({'op': 'set', 's': key, 'user': ctx.author.id, 'article': article})
             await ctx.send(f'Your article is: {article}')
 
     # Get player article
     @commands.command(name='my', aliases=['GetMyArticle', 'gma', 'GetArticle', 'ga', 'MyArticle', 'ma',], brief='Get your current article')
     @commands.dm_only()
     async def get_article(self, ctx):
+        _, game = self.session(ctx)
         try:
-            await ctx.send(f'Your article is: {self.g.my(ctx.author)}')
-        except KeyError:
+            await ctx.send(f'Your article is: {game.my(ctx.author)}')
+        except (AttributeError, KeyError):
             await ctx.send('You currently have no article')
 
     # Get article: Reply privatly
     @get_article.error
     async def my_article_error(self, ctx, error):
         if isinstance(error, commands.PrivateMessageOnly):
-            await ctx.author.send(f'Your article is: {self.g.my(ctx.author)}')
+            _, game = self.session(ctx)
+            try:
+                await ctx.author.send(f'Your article is: {game.my(ctx.author)}')
+            except (AttributeError, KeyError):
+                await ctx.author.send('You currently have no article in this game')
             await ctx.send("I replied to you privatly so the other players don't see your article")
 
     # Get random article
@@ -120,32 +261,40 @@ class Totpal(commands.Cog):
     @commands.command(name='random', aliases=['GetRandomArticle', 'gra', 'GetRandom', 'gr'], brief='Get a random article, which is not yours')
     @commands.guild_only()
     async def get_random(self, ctx):
-        if self.g.number_of_players() < 3:
-            await ctx.send(f'To few players to start the game. Only {self.g.number_of_players()} of at least 3 players.')
+        _, game = self.session(ctx)
+        number_of_players = game.number_of_players() if game else 0
+        if number_of_players < 3:
+            await ctx.send(f'To few players to start the game. Only {number_of_players} of at least 3 players.')
         else:
-            await ctx.send(f'Random article is: {self.g.random(ctx.author)}')
+            await ctx.send(f'Random article is: {game.random(ctx.author)}')
 
     # Leave game
     @commands.command(aliases=['exit'], brief='Leave the game')
     async def leave(self, ctx):
+        key, game = self.session(ctx)
         try:
-            self.g.remove(ctx.author)
+            game.remove(ctx.author)
+            self.persist({'op': 'remove', 's': key, 'user': ctx.author.id})
             await ctx.send('You left the game')
-        except KeyError:
+        except (AttributeError, KeyError):
             await ctx.send('You are currently not participating in this game')
 
     # Show players
     @commands.command(brief='Show the current players')
     async def players(self, ctx):
-        if self.g.number_of_players() == 0:
+        _, game = self.session(ctx)
+        if not game or game.number_of_players() == 0:
             await ctx.send('Currently no players')
         else:
-            await ctx.send(', '.join(i.display_name for i in list(self.g.players())))
+            await ctx.send(', '.join(i.display_name for i in game.players()))
 
     # Reset game
     @commands.command(brief='Reset the game')
     async def reset(self, ctx):
-        self.g.reset()
+        key, game = self.session(ctx)
+        if game:
+            game.reset()
+            self.persist({'op': 'reset', 's': key})
         await ctx.send('Game reset')
 
 
@@ -0,0 +1,136 @@
+import asyncio
+from collections import OrderedDict
+import hashlib
+import logging
+import os
+import time
+import uuid
+
+# Logger
+logger = logging.getLogger('discord.bot').getChild(__name__)
+
+# Partially written files older than this are left over from a crash
+STALE_PART_AGE = 86400.0
+
+
+class AudioCache:
+    """Directory of Ogg/Opus files with a byte budget and LRU eviction.
+
+    Files are written under a temporary name and renamed into place,
+    so readers never see a partially written file.
+    """
+    def __init__(self, path, max_bytes, max_downloads=2, timeout=600.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._downloads = asyncio.Semaphore(max_downloads)
+        self._writing = set()
+
+        # key -> size, least recently used first
+        self._files = OrderedDict()
+        self.size = 0
+
+        os.makedirs(path, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        now = time.time()
+        found = []
+        with os.scandir(self.path) as it:
+            for entry in it:
+                stat = entry.stat()
+                if entry.name.endswith('.part'):
+                    if stat.st_mtime < now - STALE_PART_AGE:
+                        os.unlink(entry.path)
+                elif entry.name.endswith('.ogg'):
+                    found.append((stat.st_mtime, entry.name.removesuffix('.ogg'), stat.st_size))
+
+        for _, key, size in sorted(found):
+            self._files[key] = size
+            self.size += size
+        logger.info('Audio cache %s: %s files, %s bytes', self.path, len(self._files), self.size)
+        self._evict()
+
+    @staticmethod
+    def key(webpage_url):
+        return hashlib.sha1(webpage_url.encode()).hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, f'{key}.ogg')
+
+    def _forget(self, key):
+        self.size -= self._files.pop(key, 0)
+
+    def _evict(self):
+        while self.size > self.max_bytes and self._files:
+            key = next(iter(self._files))
+            logger.info('Evicting %s from audio cache', key)
+            self._forget(key)
+            try:
+                os.unlink(self._file(key))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        return {'files': len(self._files), 'bytes': self.size, 'hits': self.hits, 'misses': self.misses, 'writing': len(self._writing)}
+
+    def lookup(self, webpage_url):
+        """Return the path of a cached file, or None"""
+        key = self.key(webpage_url)
+        if key in self._files:
+            path = self._file(key)
+            try:
+                # another process may have evicted it
+                os.utime(path)
+            except FileNotFoundError:
+                self._forget(key)
+            else:
+                self._files.move_to_end(key)
+                self.hits += 1
+                return path
+        self.misses += 1
+        return None
+
+    async def store(self, webpage_url, url, acodec):
+        """Save a stream as Ogg/Opus, unless it is already cached or being saved"""
+        key = self.key(webpage_url)
+        if key in self._files or key in self._writing:
+            return
+        self._writing.add(key)
+        part = os.path.join(self.path, f'.{key}.{uuid.uuid4().hex}.part')
+        try:
+            async with self._downloads:
+                logger.info('Saving %s to audio cache', webpage_url)
+                codec = ['-c:a', 'copy'] if acodec == 'opus' else ['-c:a', 'libopus', '-b:a', '128k']
+                process = await asyncio.create_subprocess_exec(
+                    'ffmpeg', '-nostdin', '-loglevel', 'error', '-i', url, '-vn', '-map', '0:a:0', *codec, '-f', 'ogg', part,
+                    stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+                try:
+                    _, stderr = await asyncio.wait_for(process.communicate(), self.timeout)
+                except (asyncio.TimeoutError, asyncio.CancelledError):
+                    process.kill()
+                    await process.wait()
+                    raise
+
+            if process.returncode != 0:
+                logger.warning('Failed to save %s to audio cache: %s', webpage_url, stderr.decode(errors="replace").strip())
+                return
+
+            # rename is atomic, concurrent writers of the same key just replace each other's complete file
+            os.replace(part, self._file(key))
+            self._forget(key)
+            self._files[key] = os.path.getsize(self._file(key))
+            self.size += self._files[key]
+            self._evict()
+        except asyncio.TimeoutError:
+            logger.warning('Timed out saving %s to audio cache', webpage_url)
+        except OSError:
+            logger.exception('Failed to save %s to audio cache', webpage_url)
+        finally:
+            self._writing.discard(key)
+            try:
+                os.unlink(part)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,325 @@
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import statistics
+import threading
+import time
+
+import discord
+from discord.opus import Encoder
+
+# Logger
+logger = logging.getLogger('discord.bot').getChild(__name__)
+
+# Seconds of audio per frame
+DELAY = Encoder.FRAME_LENGTH / 1000.0
+# A scheduler further behind than this skips ahead instead of sending the missed frames in a burst
+MAX_BEHIND = DELAY * 10
+# Frames read ahead per session, refilled once fewer than REFILL are left
+BUFFER = 50
+REFILL = 25
+
+
+class Session:
+    """One voice client's playback, driven by a scheduler thread.
+
+    Stands in for discord.py's AudioPlayer as the voice client's `_player`, so
+    `is_playing()`, `pause()`, `resume()` and `stop()` of the voice client work
+    as usual. Frames are read ahead into a buffer by the engine's readers, the
+    scheduler only ever takes frames that are ready.
+    """
+    def __init__(self, engine, source, client, after=None):
+        self.engine = engine
+        self.source = source
+        self.client = client
+        self.after = after
+        self._end = False
+        self._paused = False
+        self._finished = False
+        # filled by a reader, emptied by the scheduler
+        self._frames = deque()
+        self._reading = False
+        self._eof = False
+        self._error = None
+
+        self.frames = 0
+        self.underruns = 0
+        # seconds between the tick a frame belonged to and sending it
+        self.late = deque(maxlen=500)
+
+    def is_playing(self):
+        return not self._paused and not self._end
+
+    def is_paused(self):
+        return self._paused and not self._end
+
+    def stop(self):
+        # the scheduler finishes the session on its next tick
+        if not self._end:
+            self._end = True
+            self._speak(False)
+
+    def pause(self, *, update_speaking=True):
+        self._paused = True
+        if update_speaking:
+            self._speak(False)
+
+    def resume(self, *, update_speaking=True):
+        self._paused = False
+        if update_speaking:
+            self._speak(True)
+
+    def _set_source(self, source):
+        self.source = source
+        self._frames.clear()
+        self._eof = False
+        self._error = None
+
+    def _speak(self, speaking):
+        try:
+            asyncio.run_coroutine_threadsafe(self.client.ws.speak(speaking), self.client.loop)
+        except Exception as e:
+            logger.info('Speaking call in audio engine failed: %s', e)
+
+    def stats(self):
+        stats = {
+            'frames': self.frames,
+            'underruns': self.underruns,
+        }
+        # the scheduler appends meanwhile
+        late = sorted(list(self.late))
+        if late:
+            stats['jitter p50 ms'] = round(late[len(late) // 2] * 1000, 2)
+            stats['jitter p99 ms'] = round(late[int(len(late) * 0.99)] * 1000, 2)
+        return stats
+
+    def fill(self):
+        """Read ahead until the buffer is full, run by a reader thread"""
+        source = self.source
+        try:
+            # reads block while FFmpeg starts, stalls or restarts
+            while len(self._frames) < BUFFER and not self._end:
+                data = source.read()
+                if source is not self.source:
+                    break
+                if not data:
+                    self._eof = True
+                    break
+                self._frames.append(data)
+        except Exception as e:
+            if source is self.source:
+                self._error = e
+        finally:
+            self._reading = False
+
+    def step(self, tick, refills):
+        """Send the frame of the tick due at `tick`, return False once the session is over.
+
+        Appends itself to `refills` when its buffer runs low.
+        """
+        if self._end:
+            self.finish(None)
+            return False
+        if self._paused or not self.client._connected.is_set():
+            return True
+
+        if not self._reading and not self._eof and self._error is None and len(self._frames) < REFILL:
+            self._reading = True
+            refills.append(self)
+        if not self._frames:
+            if self._error is not None or self._eof:
+                self._end = True
+                self._speak(False)
+                self.finish(self._error)
+                return False
+            if self.frames:
+                # nothing to send, the listener hears a gap
+                self.underruns += 1
+            return True
+
+        try:
+            self.client.send_audio_packet(self._frames.popleft(), encode=not self.source.is_opus())
+        except Exception as e:
+            self._end = True
+            self._speak(False)
+            self.finish(e)
+            return False
+
+        late = time.perf_counter() - tick
+        self.late.append(late)
+        self.frames += 1
+        if late > DELAY:
+            # the frame missed its slot, the listener hears a gap
+            self.underruns += 1
+        return True
+
+    def finish(self, error):
+        if self._finished:
+            return
+        self._finished = True
+        self.engine.finished(self, error)
+
+
+class Scheduler(threading.Thread):
+    """Sends a frame for each of its sessions every 20 ms"""
+    def __init__(self, index):
+        super().__init__(name=f'audio-{index}', daemon=True)
+        self.sessions = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+
+        self.ticks = 0
+        self.skipped = 0
+        # seconds a pass over all sessions took
+        self.busy = deque(maxlen=500)
+
+    def add(self, session):
+        with self._lock:
+            self.sessions.append(session)
+        self._wakeup.set()
+
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+
+    def run(self):
+        tick = None
+        while not self._closed:
+            if not self.sessions:
+                self._wakeup.clear()
+                # sessions added meanwhile set the event again
+                if not self.sessions:
+                    self._wakeup.wait()
+                tick = None
+                continue
+
+            now = time.perf_counter()
+            if tick is None:
+                tick = now
+            elif now - tick > MAX_BEHIND:
+                self.skipped += int((now - tick) / DELAY)
+                tick = now
+
+            with self._lock:
+                sessions = list(self.sessions)
+            refills = []
+            over = [session for session in sessions if not session.step(tick, refills)]
+            # reading while the scheduler sleeps keeps readers from taking the GIL mid-pass
+            for session in refills:
+                session.engine.read(session)
+            if over:
+                with self._lock:
+                    self.sessions = [session for session in self.sessions if session not in over]
+
+            self.ticks += 1
+            self.busy.append(time.perf_counter() - now)
+            tick += DELAY
+            delay = tick - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+        for session in list(self.sessions):
+            session.finish(None)
+
+
+class AudioEngine:
+    """Plays the audio of all voice clients from a fixed number of threads.
+
+    Instead of one AudioPlayer thread per voice client, which all wake up every
+    20 ms on their own, sessions are spread over `threads` schedulers on a
+    shared tick. Each tick a scheduler sends the next frame of every session in
+    one pass. Frames are read ahead in batches by up to `readers` threads, so a
+    source blocked on FFmpeg only delays its own session, as long as fewer than
+    `readers` are blocked at once. Sources are cleaned up and `after` callbacks
+    run on a separate thread, so stopping FFmpeg never delays a tick either.
+    """
+    def __init__(self, threads=1, readers=32):
+        self.schedulers = [Scheduler(index) for index in range(threads)]
+        for scheduler in self.schedulers:
+            scheduler.start()
+        # threads are only started while all others are busy
+        self._readers = ThreadPoolExecutor(readers, 'audio-read')
+        self._finisher = ThreadPoolExecutor(1, 'audio-finish')
+
+        self.played = 0
+        self.failed = 0
+        # counters of sessions that are over
+        self.frames = 0
+        self.underruns = 0
+
+    def play(self, client, source, *, after=None):
+        """Play `source` on a voice client, like VoiceClient.play()"""
+        if not client.is_connected():
+            raise discord.ClientException('Not connected to voice.')
+        if client.is_playing():
+            raise discord.ClientException('Already playing audio.')
+        if not isinstance(source, discord.AudioSource):
+            raise TypeError(f'source must an AudioSource not {source.__class__.__name__}')
+        if not client.encoder and not source.is_opus():
+            client.encoder = discord.opus.Encoder()
+
+        session = Session(self, source, client, after)
+        client._player = session
+        session._speak(True)
+        min(self.schedulers, key=lambda scheduler: len(scheduler.sessions)).add(session)
+        self.played += 1
+        return session
+
+    def read(self, session):
+        self._readers.submit(session.fill)
+
+    def sessions(self):
+        return [session for scheduler in self.schedulers for session in scheduler.sessions]
+
+    def finished(self, session, error):
+        # called by the scheduler
+        self.frames += session.frames
+        self.underruns += session.underruns
+        if error:
+            self.failed += 1
+        self._finisher.submit(self._call_after, session, error)
+
+    def _call_after(self, session, error):
+        try:
+            session.source.cleanup()
+        except Exception:
+            logger.exception('Failed to clean up audio source')
+        if session.after is not None:
+            try:
+                session.after(error)
+            except Exception:
+                logger.exception('Calling the after function failed')
+        elif error:
+            logger.error('Exception in audio engine', exc_info=error)
+
+    def stats(self):
+        sessions = self.sessions()
+        stats = {
+            'sessions': len(sessions),
+            'played': self.played,
+            'failed': self.failed,
+            'frames': self.frames + sum(session.frames for session in sessions),
+            'underruns': self.underruns + sum(session.underruns for session in sessions),
+            'skipped ticks': sum(scheduler.skipped for scheduler in self.schedulers),
+        }
+        # the schedulers append meanwhile, aggregate snapshots
+        busy = [seconds for scheduler in self.schedulers for seconds in list(scheduler.busy)]
+        if busy:
+            stats['tick p50 ms'] = round(statistics.median(busy) * 1000, 2)
+            stats['tick max ms'] = round(max(busy) * 1000, 2)
+        late = [seconds for session in sessions for seconds in list(session.late)]
+        if late:
+            late.sort()
+            stats['jitter p50 ms'] = round(late[len(late) // 2] * 1000, 2)
+            stats['jitter p99 ms'] = round(late[int(len(late) * 0.99)] * 1000, 2)
+        return stats
+
+    def close(self):
+        for scheduler in self.schedulers:
+            scheduler.close()
+        for scheduler in self.schedulers:
+            scheduler.join()
+        self._readers.shutdown(wait=False, cancel_futures=True)
+        self._finisher.shutdown(wait=False)
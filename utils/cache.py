@@ -0,0 +1,249 @@
+import asyncio
+from collections import OrderedDict
+import json
+import logging
+import sqlite3
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+# Logger
+logger = logging.getLogger('discord.bot').getChild(__name__)
+
+# Seconds before a signed stream URL's own expiry at which we stop handing it out
+URL_EXPIRY_MARGIN = 300.0
+
+
+def normalize_search(search):
+    """Normalize a search string or URL into a cache key"""
+    search = search.strip()
+    # URLs (video ids) are case sensitive
+    if '://' in search:
+        return search
+    return ' '.join(search.lower().split())
+
+
+def url_expiry(url, now, ttl):
+    """Return when a stream URL should be considered expired"""
+    expires = now + ttl
+    try:
+        # googlevideo URLs carry their own expiry timestamp
+        expire = parse_qs(urlparse(url).query).get('expire')
+        if expire:
+            expires = min(expires, float(expire[0]) - URL_EXPIRY_MARGIN)
+    except (TypeError, ValueError):
+        pass
+    return expires
+
+
+class InfoCache:
+    """LRU/TTL cache for video info with an optional sqlite tier.
+
+    Concurrent lookups of the same key share a single extraction.
+    The stream URL is kept for `url_ttl` seconds, the rest of the info for `ttl` seconds.
+    """
+    def __init__(self, maxsize=1024, ttl=86400.0, url_ttl=1800.0, path=None, clock=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.url_ttl = url_ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.coalesced = 0
+
+        # key -> (info, expires, url_expires)
+        self._entries = OrderedDict()
+        self._inflight = {}
+
+        self._db = None
+        self._db_lock = threading.Lock()
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, info TEXT, expires REAL, url_expires REAL)')
+            self._db.commit()
+            logger.info('Using info cache database %s', path)
+
+    def stats(self):
+        """Return the cache counters"""
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'refreshes': self.refreshes,
+            'coalesced': self.coalesced,
+            'inflight': len(self._inflight),
+        }
+
+    def cached(self, search):
+        """Return whether valid metadata for `search` is held in memory"""
+        key = normalize_search(search)
+        return self._valid(key, self._entries.get(key)) is not None
+
+    def close(self):
+        if self._db:
+            with self._db_lock:
+                self._db.close()
+            self._db = None
+
+    # sqlite tier, run in a worker thread
+    def _db_get(self, key):
+        with self._db_lock:
+            if not self._db:
+                return None
+            row = self._db.execute('SELECT info, expires, url_expires FROM info WHERE key = ?', (key,)).fetchone()
+        if row:
+            return json.loads(row[0]), row[1], row[2]
+        return None
+
+    def _db_put(self, key, entry):
+        with self._db_lock:
+            if not self._db:
+                return
+            self._db.execute('REPLACE INTO info VALUES (?, ?, ?, ?)', (key, json.dumps(entry[0]), entry[1], entry[2]))
+            self._db.execute('DELETE FROM info WHERE expires < ?', (self.clock(),))
+            self._db.commit()
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _valid(self, key, entry):
+        """Return entry if its metadata is still valid"""
+        if entry and entry[1] <= self.clock():
+            self._entries.pop(key, None)
+            return None
+        return entry
+
+    async def _resolve(self, key, search, entry, extract):
+        # second tier
+        if entry is None and self._db:
+            entry = self._valid(key, await asyncio.to_thread(self._db_get, key))
+            if entry:
+                self._remember(key, entry)
+                if entry[2] > self.clock():
+                    self.hits += 1
+                    return entry[0]
+
+        # metadata is still good, only re-resolve the stream URL from the stable page URL
+        if entry:
+            self.refreshes += 1
+            query = entry[0].get('webpage_url') or search
+        else:
+            self.misses += 1
+            query = search
+
+        info = await extract(query)
+        now = self.clock()
+        entry = (info, now + self.ttl, url_expiry(info.get('url'), now, self.url_ttl))
+        self._remember(key, entry)
+        if self._db:
+            await asyncio.to_thread(self._db_put, key, entry)
+        return info
+
+    async def fetch(self, search, extract):
+        """Return the info for `search`, calling `await extract(query)` on a miss.
+
+        Returns a shallow copy, callers may add their own keys.
+        """
+        key = normalize_search(search)
+
+        task = self._inflight.get(key)
+        if task:
+            self.coalesced += 1
+        else:
+            entry = self._valid(key, self._entries.get(key))
+            if entry and entry[2] > self.clock():
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return dict(entry[0])
+
+            task = self._inflight[key] = asyncio.ensure_future(self._resolve(key, search, entry, extract))
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+
+        # shield, so a cancelled command doesn't cancel the extraction for everyone else
+        return dict(await asyncio.shield(task))
+
+
+class SearchCache:
+    """TTL cache of flat search results, and of the results last shown to each user.
+
+    Concurrent searches for the same query share a single extraction. Results
+    shown to a user are kept under a key of the caller's choosing, e.g. channel
+    and user, so a choice can be taken from them without searching again.
+    """
+    def __init__(self, maxsize=256, ttl=600.0, max_shown=4096, clock=time.time):
+        self.maxsize = maxsize
+        self.max_shown = max_shown
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+        # query -> (results, expires)
+        self._results = OrderedDict()
+        # key -> (results, expires)
+        self._shown = OrderedDict()
+        self._inflight = {}
+
+    def stats(self):
+        """Return the cache counters"""
+        return {
+            'size': len(self._results),
+            'shown': len(self._shown),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+        }
+
+    async def _search(self, key, search, extract):
+        self.misses += 1
+        results = await extract(search)
+        self._remember(self._results, key, results, self.maxsize)
+        return results
+
+    async def fetch(self, search, extract):
+        """Return the results for `search`, calling `await extract(search)` on a miss"""
+        key = normalize_search(search)
+
+        task = self._inflight.get(key)
+        if task:
+            self.coalesced += 1
+        else:
+            results = self._valid(self._results, key)
+            if results is not None:
+                self.hits += 1
+                return results
+
+            task = self._inflight[key] = asyncio.ensure_future(self._search(key, search, extract))
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+
+        # shield, so a cancelled command doesn't cancel the search for everyone else
+        return await asyncio.shield(task)
+
+    def show(self, key, results):
+        """Remember the results shown under `key`"""
+        self._remember(self._shown, key, results, self.max_shown)
+
+    def shown(self, key):
+        """Return the results last shown under `key`, None if they expired"""
+        return self._valid(self._shown, key)
+
+    def _remember(self, entries, key, results, maxsize):
+        entries[key] = (results, self.clock() + self.ttl)
+        entries.move_to_end(key)
+        while len(entries) > maxsize:
+            entries.popitem(last=False)
+
+    def _valid(self, entries, key):
+        entry = entries.get(key)
+        if entry and entry[1] <= self.clock():
+            del entries[key]
+            return None
+        if entry:
+            entries.move_to_end(key)
+            return entry[0]
+        return None
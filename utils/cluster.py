@@ -0,0 +1,235 @@
+import asyncio
+import itertools
+import json
+import logging
+import signal
+
+# Logger
+logger = logging.getLogger('discord.bot').getChild(__name__)
+
+# Restart delays of crashed workers in sec, reset once a worker ran for STABLE_AFTER
+MIN_BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+STABLE_AFTER = 60.0
+# Seconds to wait for the other clusters to answer a broadcast
+BROADCAST_TIMEOUT = 10.0
+
+
+def shard_range(shard_count, clusters, cluster_id):
+    """Return the contiguous range of shards a cluster owns"""
+    return range(cluster_id * shard_count // clusters, (cluster_id + 1) * shard_count // clusters)
+
+async def send(writer, message):
+    writer.write(json.dumps(message).encode() + b'\n')
+    await writer.drain()
+
+
+class Supervisor:
+    """Runs one bot process per cluster and relays messages between them.
+
+    Workers are started as `command --cluster-id N --ipc PATH` and restarted with
+    exponential backoff when they exit. Once every worker reported ready `on_ready`
+    is called. Every `alive_interval` seconds `on_alive` is called if every running
+    worker reported a healthy event loop within the last `alive_timeout` seconds,
+    starting workers included. Workers should report several times per interval.
+    """
+    def __init__(self, command, clusters, ipc_path, on_ready=None, on_alive=None, alive_interval=None, alive_timeout=None):
+        self.command = command
+        self.clusters = clusters
+        self.ipc_path = ipc_path
+        self.on_ready = on_ready
+        self.on_alive = on_alive
+        self.alive_interval = alive_interval
+        self.alive_timeout = alive_timeout
+        self.processes = {}
+        self.writers = {}
+        self.ready = set()
+        # cluster -> loop time of its last report, only while its process runs
+        self.alive = {}
+        self.all_ready = False
+        # (sender, broadcast id) -> (clusters yet to answer, results)
+        self.pending = {}
+        self._stop = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, self._stop.set)
+        # workers reload their extensions
+        loop.add_signal_handler(signal.SIGHUP, self.signal_workers, signal.SIGHUP)
+
+        server = await asyncio.start_unix_server(self._serve, self.ipc_path)
+        tasks = [loop.create_task(self._supervise(cluster)) for cluster in range(self.clusters)]
+        if self.on_alive:
+            tasks.append(loop.create_task(self._watch_alive()))
+
+        await self._stop.wait()
+        logger.info('Stopping clusters')
+        server.close()
+        for task in tasks:
+            task.cancel()
+        self.signal_workers(signal.SIGTERM)
+        await asyncio.gather(*(process.wait() for process in self.processes.values()))
+
+    def signal_workers(self, signum):
+        for process in self.processes.values():
+            if process.returncode is None:
+                process.send_signal(signum)
+
+    async def _supervise(self, cluster):
+        loop = asyncio.get_running_loop()
+        backoff = MIN_BACKOFF
+        while True:
+            started = loop.time()
+            process = self.processes[cluster] = await asyncio.create_subprocess_exec(*self.command, '--cluster-id', str(cluster), '--ipc', self.ipc_path)
+            logger.info('Started cluster %s, pid %s', cluster, process.pid)
+            # time to import, connect and start reporting
+            self.alive[cluster] = loop.time()
+            code = await process.wait()
+            self.ready.discard(cluster)
+            self.writers.pop(cluster, None)
+            # a crashed worker is restarted, not hung
+            self.alive.pop(cluster, None)
+
+            if loop.time() - started > STABLE_AFTER:
+                backoff = MIN_BACKOFF
+            logger.warning('Cluster %s exited with %s, restarting in %s seconds', cluster, code, backoff)
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, MAX_BACKOFF)
+
+    async def _watch_alive(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.alive_interval)
+            now = loop.time()
+            late = [cluster for cluster, seen in self.alive.items() if now - seen >= self.alive_timeout]
+            if late:
+                logger.warning('Clusters %s stopped reporting a healthy event loop', late)
+            else:
+                self.on_alive()
+
+    async def _serve(self, reader, writer):
+        cluster = None
+        try:
+            while line := await reader.readline():
+                message = json.loads(line)
+                op = message['op']
+                if op == 'hello':
+                    cluster = message['cluster']
+                    self.writers[cluster] = writer
+                elif op == 'ready':
+                    self.ready.add(cluster)
+                    logger.info('Cluster %s is ready, %s of %s', cluster, len(self.ready), self.clusters)
+                    if len(self.ready) == self.clusters and not self.all_ready:
+                        self.all_ready = True
+                        if self.on_ready:
+                            self.on_ready()
+                elif op == 'alive':
+                    if cluster in self.alive:
+                        self.alive[cluster] = asyncio.get_running_loop().time()
+                elif op == 'broadcast':
+                    await self._broadcast(cluster, message)
+                elif op == 'result':
+                    await self._result(cluster, message)
+        except (ConnectionError, ValueError, KeyError):
+            logger.exception('Invalid message from cluster %s', cluster)
+        finally:
+            if self.writers.get(cluster) is writer:
+                del self.writers[cluster]
+            writer.close()
+
+    async def _broadcast(self, sender, message):
+        others = {cluster: writer for cluster, writer in self.writers.items() if cluster != sender}
+        key = (sender, message['id'])
+        # clusters being restarted can't run it
+        self.pending[key] = (set(others), {cluster: 'not running' for cluster in range(self.clusters) if cluster != sender and cluster not in others})
+        for writer in others.values():
+            await send(writer, {'op': 'run', 'id': message['id'], 'from': sender, 'action': message['action'], 'args': message['args']})
+        asyncio.get_running_loop().call_later(BROADCAST_TIMEOUT, lambda: asyncio.ensure_future(self._answer(key)))
+        if not others:
+            await self._answer(key)
+
+    async def _result(self, cluster, message):
+        key = (message['from'], message['id'])
+        if key not in self.pending:
+            return
+        remaining, results = self.pending[key]
+        remaining.discard(cluster)
+        results[cluster] = message['result']
+        if not remaining:
+            await self._answer(key)
+
+    async def _answer(self, key):
+        if key not in self.pending:
+            return
+        remaining, results = self.pending.pop(key)
+        for cluster in remaining:
+            results[cluster] = 'no answer'
+        writer = self.writers.get(key[0])
+        if writer:
+            await send(writer, {'op': 'results', 'id': key[1], 'results': results})
+
+
+class ClusterClient:
+    """A worker's connection to the supervisor.
+
+    `handler(action, *args)` runs actions broadcast by other clusters and returns
+    a string. `on_lost` is called when the supervisor goes away.
+    """
+    def __init__(self, path, cluster, handler, on_lost=None):
+        self.path = path
+        self.cluster = cluster
+        self.handler = handler
+        self.on_lost = on_lost
+        self._writer = None
+        self._loop = None
+        self._ids = itertools.count()
+        self._waiting = {}
+
+    async def connect(self):
+        self._loop = asyncio.get_running_loop()
+        reader, self._writer = await asyncio.open_unix_connection(self.path)
+        await send(self._writer, {'op': 'hello', 'cluster': self.cluster})
+        self._loop.create_task(self._read(reader))
+
+    def ready(self):
+        self._loop.create_task(send(self._writer, {'op': 'ready'}))
+
+    def alive(self):
+        """Report a healthy event loop, may be called from any thread"""
+        if self._writer is None:
+            return
+        # only gets through if the loop is actually running callbacks
+        self._loop.call_soon_threadsafe(lambda: self._loop.create_task(send(self._writer, {'op': 'alive'})))
+
+    async def broadcast(self, action, *args):
+        """Run an action on all other clusters and return their results by cluster"""
+        id = next(self._ids)
+        future = self._waiting[id] = self._loop.create_future()
+        await send(self._writer, {'op': 'broadcast', 'id': id, 'action': action, 'args': args})
+        try:
+            results = await asyncio.wait_for(future, BROADCAST_TIMEOUT * 2)
+        finally:
+            self._waiting.pop(id, None)
+        return {int(cluster): result for cluster, result in results.items()}
+
+    async def _read(self, reader):
+        try:
+            while line := await reader.readline():
+                message = json.loads(line)
+                if message['op'] == 'run':
+                    try:
+                        result = self.handler(message['action'], *message['args'])
+                    except Exception as e:
+                        result = f'🛑 `{type(e).__name__}: {e}`'
+                    await send(self._writer, {'op': 'result', 'id': message['id'], 'from': message['from'], 'result': result})
+                elif message['op'] == 'results':
+                    future = self._waiting.get(message['id'])
+                    if future and not future.done():
+                        future.set_result(message['results'])
+        except ConnectionError:
+            pass
+        logger.warning('Lost connection to the cluster supervisor')
+        if self.on_lost:
+            self.on_lost()
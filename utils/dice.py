@@ -0,0 +1,218 @@
+from functools import lru_cache
+import heapq
+import math
+import random
+import re
+
+# Rolls with more dice are summed by sampling the distribution of the sum
+SAMPLE_ABOVE = 1000
+# Dice rolled one by one, i.e. kept/dropped, exploding or shown
+MAX_INDIVIDUAL = 10000
+# Upper bound of the work a single expression may cause
+MAX_COST = 20000
+MAX_TERMS = 20
+MAX_NUMBER = 10**12
+# An exploding die rolls at most this often
+MAX_EXPLOSIONS = 100
+MESSAGE_LIMIT = 2000
+
+TERM = re.compile(r'([+-])(?:(\d*)d(\d+|%)(!)?(?:(kh|kl|dh|dl|k)(\d+))?|(\d+))')
+COMPARISON = re.compile(r'(>=|<=|==|!=|>|<|=)')
+COMPARE = {
+    '>=': lambda a, b: a >= b,
+    '<=': lambda a, b: a <= b,
+    '==': lambda a, b: a == b,
+    '=': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '>': lambda a, b: a > b,
+    '<': lambda a, b: a < b,
+}
+
+
+class DiceError(ValueError):
+    """Invalid or too expensive dice expression"""
+
+
+class Dice:
+    __slots__ = ('sign', 'count', 'sides', 'explode', 'keep')
+
+    def __init__(self, sign, count, sides, explode=False, keep=None):
+        self.sign = sign
+        self.count = count
+        self.sides = sides
+        self.explode = explode
+        # ('h' or 'l', number of dice)
+        self.keep = keep
+
+    def individual(self, verbose):
+        """Whether the dice have to be rolled one by one"""
+        return self.explode or self.keep is not None or (verbose and self.count <= MAX_INDIVIDUAL)
+
+    def cost(self, verbose):
+        if self.individual(verbose):
+            # an exploding die rolls sides / (sides - 1) times on average
+            return self.count * (2 if self.explode else 1)
+        return min(self.count, SAMPLE_ABOVE)
+
+    def roll_one(self):
+        value = roll = random.randint(1, self.sides)
+        explosions = 0
+        while self.explode and roll == self.sides and explosions < MAX_EXPLOSIONS:
+            roll = random.randint(1, self.sides)
+            value += roll
+            explosions += 1
+        return value
+
+    def roll(self, verbose):
+        """Return the sum and the per die output or None"""
+        if not self.individual(verbose):
+            if self.count > SAMPLE_ABOVE:
+                return sample_sum(self.count, self.sides), None
+            return sum(random.choices(range(1, self.sides + 1), k=self.count)), None
+
+        if self.explode:
+            rolls = [self.roll_one() for _ in range(self.count)]
+        else:
+            rolls = random.choices(range(1, self.sides + 1), k=self.count)
+        kept = rolls
+        if self.keep:
+            which, n = self.keep
+            kept = heapq.nlargest(n, rolls) if which == 'h' else heapq.nsmallest(n, rolls)
+        total = sum(kept)
+        if not verbose:
+            return total, None
+
+        # strike out dropped dice
+        dropped = {}
+        if kept is not rolls:
+            remaining = {}
+            for value in kept:
+                remaining[value] = remaining.get(value, 0) + 1
+            for value in rolls:
+                if remaining.get(value):
+                    remaining[value] -= 1
+                else:
+                    dropped[value] = dropped.get(value, 0) + 1
+        shown = []
+        for value in rolls:
+            if dropped.get(value):
+                dropped[value] -= 1
+                shown.append(f'~~{value}~~')
+            else:
+                shown.append(str(value))
+        return total, f'[{", ".join(shown)}]'
+
+    def __str__(self):
+        keep = f'k{self.keep[0]}{self.keep[1]}' if self.keep else ''
+        return f'{self.count}d{self.sides}{"!" if self.explode else ""}{keep}'
+
+
+class Constant:
+    __slots__ = ('sign', 'value')
+
+    def __init__(self, sign, value):
+        self.sign = sign
+        self.value = value
+
+    def cost(self, verbose):
+        return 0
+
+    def roll(self, verbose):
+        return self.value, None
+
+    def __str__(self):
+        return str(self.value)
+
+
+def sample_sum(count, sides):
+    """Sample the sum of `count` dice from its normal approximation"""
+    mean = count * (sides + 1) / 2
+    deviation = math.sqrt(count * (sides * sides - 1) / 12)
+    return min(count * sides, max(count, round(random.gauss(mean, deviation))))
+
+def number(text):
+    # int() refuses more than 4300 digits, leading zeros included, with a plain ValueError
+    digits = text.lstrip('0') or '0'
+    if len(digits) > len(str(MAX_NUMBER)) or int(digits) > MAX_NUMBER:
+        raise DiceError(f'{text if len(text) <= 20 else text[:20] + "…"} is too large')
+    return int(digits)
+
+@lru_cache(maxsize=1024)
+def parse(expression):
+    """Parse e.g. `4d6kh3 + 2d8! - 1 >= 20` into (terms, comparison operator, comparison value)"""
+    expression = ''.join(expression.lower().split())
+    parts = COMPARISON.split(expression)
+    if len(parts) not in (1, 3):
+        raise DiceError('Only one comparison is allowed')
+    operator, target = (parts[1], number(parts[2])) if len(parts) == 3 and parts[2].isdigit() else (None, None)
+    if len(parts) == 3 and operator is None:
+        raise DiceError('Dice can only be compared with a number')
+
+    text = parts[0] if parts[0][:1] in '+-' and parts[0] else '+' + parts[0]
+    terms = []
+    position = 0
+    while position < len(text):
+        match = TERM.match(text, position)
+        if not match:
+            raise DiceError(f'Can\'t read `{text[position:] if position else parts[0]}`')
+        position = match.end()
+        sign = -1 if match[1] == '-' else 1
+        if match[7] is not None:
+            terms.append(Constant(sign, number(match[7])))
+            continue
+
+        count = number(match[2]) if match[2] else 1
+        sides = 100 if match[3] == '%' else number(match[3])
+        if count < 1 or sides < 1:
+            raise DiceError('Dice need at least one die with at least one side')
+        if match[4] and sides == 1:
+            raise DiceError('A one-sided die can\'t explode')
+        keep = None
+        if match[5]:
+            n = number(match[6])
+            if match[5] in ('kh', 'k'):
+                keep = ('h', min(n, count))
+            elif match[5] == 'kl':
+                keep = ('l', min(n, count))
+            elif match[5] == 'dh':
+                keep = ('l', max(count - n, 0))
+            else:
+                keep = ('h', max(count - n, 0))
+        terms.append(Dice(sign, count, sides, bool(match[4]), keep))
+
+    if not terms:
+        raise DiceError('Nothing to roll')
+    if len(terms) > MAX_TERMS:
+        raise DiceError(f'At most {MAX_TERMS} terms are allowed')
+    return tuple(terms), operator, target
+
+def roll(expression, verbose=False):
+    """Roll a dice expression and return the text to reply with"""
+    terms, operator, target = parse(expression)
+    cost = sum(term.cost(verbose) for term in terms)
+    if cost > MAX_COST:
+        raise DiceError('Too many dice to roll one by one')
+
+    total = 0
+    details = []
+    for term in terms:
+        value, detail = term.roll(verbose)
+        total += term.sign * value
+        if verbose:
+            if isinstance(term, Constant):
+                detail = ''
+            elif detail is None:
+                detail = f' ({value})'
+            else:
+                detail = f' {detail}'
+            details.append(f'{"-" if term.sign < 0 else "+"} {term}{detail}')
+
+    result = str(total)
+    if operator:
+        result = f'{total} {operator} {target}: {"success" if COMPARE[operator](total, target) else "failure"}'
+    if verbose:
+        shown = ' '.join(details).removeprefix('+ ')
+        if len(shown) + len(result) + 3 > MESSAGE_LIMIT:
+            shown = shown[:shown.rfind(' ', 0, MESSAGE_LIMIT - len(result) - 5)] + ' …'
+        result = f'{shown} = {result}'
+    return result
@@ -0,0 +1,166 @@
+import asyncio
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import logging
+import statistics
+import threading
+import time
+
+# Logger
+logger = logging.getLogger('discord.bot').getChild(__name__)
+
+# youtube_dl takes longer to import than the rest of the bot, the first worker imports it
+YoutubeDL = None
+
+# Each worker thread/process gets its own YoutubeDL, they are not thread-safe
+_local = threading.local()
+
+def _init_worker(opts, logger_name):
+    global YoutubeDL
+    if YoutubeDL is None:
+        started = time.perf_counter()
+        from youtube_dl import YoutubeDL
+        logger.info('Imported youtube_dl in %.0f ms', (time.perf_counter() - started) * 1000)
+    opts = dict(opts, logger=logging.getLogger(logger_name))
+    _local.ydl = YoutubeDL(opts)
+
+def _call(func, args):
+    return func(_local.ydl, *args)
+
+
+class PoolFull(Exception):
+    """Too many extractions are waiting already"""
+
+
+class ExtractorPool:
+    """Runs youtube-dl calls on a fixed number of workers.
+
+    `func(ydl, *args)` is run with the worker's own YoutubeDL instance.
+    Waiting requests are served round-robin per key (guild), so one guild queueing
+    a lot can't starve the others. With `processes`, jobs submitted with `process=True`
+    run in a process pool and must be picklable.
+    """
+    def __init__(self, opts, logger_name, workers=4, max_pending=100, timeout=60.0, processes=False):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+
+        # opts are passed to the workers without the logger, it can't be pickled
+        opts = {k: v for k, v in opts.items() if k != 'logger'}
+        self._threads = ThreadPoolExecutor(workers, 'ydl', _init_worker, (opts, logger_name))
+        self._processes = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(opts, logger_name)) if processes else None
+
+        # key -> deque of (future, func, args, process, enqueued), keys in round-robin order
+        self._pending = {}
+        self._order = deque()
+        self.depth = 0
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.wait_times = deque(maxlen=500)
+        self.run_times = deque(maxlen=500)
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._worker()) for _ in range(self.workers)]
+
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
+        for jobs in self._pending.values():
+            for job in jobs:
+                job[0].cancel()
+        self._pending.clear()
+        self._order.clear()
+        self.depth = 0
+        self._threads.shutdown(wait=False, cancel_futures=True)
+        if self._processes:
+            self._processes.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        stats = {
+            'pending': self.depth,
+            'running': self.running,
+            'completed': self.completed,
+            'failed': self.failed,
+            'timeouts': self.timeouts,
+            'rejected': self.rejected,
+        }
+        if self.run_times:
+            stats['wait p50 ms'] = round(statistics.median(self.wait_times) * 1000)
+            stats['run p50 ms'] = round(statistics.median(self.run_times) * 1000)
+            stats['run max ms'] = round(max(self.run_times) * 1000)
+        return stats
+
+    async def run(self, func, *args, key=None, process=False):
+        """Run `func(ydl, *args)` on a worker and return its result"""
+        if not self._tasks:
+            self.start()
+        if self.depth >= self.max_pending:
+            self.rejected += 1
+            raise PoolFull()
+
+        future = asyncio.get_running_loop().create_future()
+        if key not in self._pending:
+            self._pending[key] = deque()
+            self._order.append(key)
+        self._pending[key].append((future, func, args, process, time.perf_counter()))
+        self.depth += 1
+        self._wakeup.set()
+
+        # a cancelled caller also cancels the future, the worker then skips it
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+
+    def _next_job(self):
+        while self._order:
+            key = self._order.popleft()
+            jobs = self._pending[key]
+            job = jobs.popleft()
+            self.depth -= 1
+            if jobs:
+                self._order.append(key)
+            else:
+                del self._pending[key]
+            if not job[0].done():
+                return job
+        return None
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = self._next_job()
+            if job is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            future, func, args, process, enqueued = job
+            executor = self._processes if process and self._processes else self._threads
+            started = time.perf_counter()
+            self.wait_times.append(started - enqueued)
+            self.running += 1
+            try:
+                result = await loop.run_in_executor(executor, _call, func, args)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                self.failed += 1
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                self.completed += 1
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                self.running -= 1
+                self.run_times.append(time.perf_counter() - started)
@@ -0,0 +1,136 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+
+# Logger
+logger = logging.getLogger('discord.bot').getChild(__name__)
+
+
+class Journal:
+    """Append-only journal of JSON records, periodically compacted into a snapshot.
+
+    Every record is flushed to the OS as it is appended, so a crashed or reloaded
+    process loses nothing. Compaction atomically replaces the snapshot with records
+    describing the whole state and starts a journal of only the records appended
+    since. The snapshot is written and synced on a thread while appends go on.
+    """
+    def __init__(self, path, compact_after=1000):
+        self.path = path
+        self.snapshot_path = path + '.snapshot'
+        self.compact_after = compact_after
+        self.seq = 0
+        self.appended = 0
+        self._file = None
+        # snapshots are written one after another, in the order they were taken
+        self._writer = ThreadPoolExecutor(1, 'journal')
+        self._compactions = 0
+        # (seq, line) appended while a snapshot is written
+        self._pending = None
+
+    def replay(self):
+        """Return the records of the snapshot and the journal, and open the journal for appending"""
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        records = []
+        snapshot_seq = 0
+        try:
+            with open(self.snapshot_path, 'rb') as f:
+                snapshot_seq = json.loads(f.readline())['seq']
+                records.extend(json.loads(line) for line in f)
+        except FileNotFoundError:
+            pass
+        self.seq = snapshot_seq
+
+        # a crash may have left a partially written last line
+        good = 0
+        try:
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    try:
+                        seq, record = json.loads(line)
+                    except ValueError:
+                        logger.warning('Ignoring truncated record in %s', self.path)
+                        break
+                    good += len(line)
+                    # records from before a compaction which crashed before truncating the journal
+                    if seq > snapshot_seq:
+                        records.append(record)
+                        self.seq = seq
+                        self.appended += 1
+        except FileNotFoundError:
+            pass
+
+        self._file = open(self.path, 'ab')
+        self._file.truncate(good)
+        logger.info('Replayed %s records from %s', len(records), self.path)
+        return records
+
+    def append(self, record):
+        self.seq += 1
+        line = json.dumps([self.seq, record], separators=(',', ':')).encode() + b'\n'
+        self._file.write(line)
+        self._file.flush()
+        self.appended += 1
+        if self._pending is not None:
+            self._pending.append((self.seq, line))
+
+    @property
+    def needs_compaction(self):
+        return self.appended >= self.compact_after and not self._compactions
+
+    def compact(self, records):
+        """Replace snapshot and journal with records describing the current state.
+
+        Must be called on the event loop, with records taken at the current
+        sequence number. Returns a concurrent future of the snapshot write.
+        """
+        loop = asyncio.get_running_loop()
+        seq = self.seq
+        if self._pending is None:
+            self._pending = []
+        self._compactions += 1
+        future = self._writer.submit(self._write_snapshot, seq, records)
+        future.add_done_callback(lambda future: loop.call_soon_threadsafe(self._compacted, seq, future))
+        return future
+
+    def _write_snapshot(self, seq, records):
+        # runs on the writer thread
+        tmp = f'{self.snapshot_path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(json.dumps({'seq': seq}).encode() + b'\n')
+            for record in records:
+                f.write(json.dumps(record, separators=(',', ':')).encode() + b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.snapshot_path)
+
+    def _compacted(self, seq, future):
+        self._compactions -= 1
+        pending = [(s, line) for s, line in self._pending if s > seq]
+        self._pending = pending if self._compactions else None
+        if future.cancelled() or self._file is None:
+            return
+        if future.exception():
+            logger.error('Failed to compact %s', self.path, exc_info=future.exception())
+            return
+
+        # records up to seq are in the snapshot now, replay skips them until then
+        if pending:
+            tmp = f'{self.path}.{os.getpid()}.tmp'
+            with open(tmp, 'wb') as f:
+                f.writelines(line for s, line in pending)
+            os.replace(tmp, self.path)
+            self._file.close()
+            self._file = open(self.path, 'ab')
+        else:
+            self._file.truncate(0)
+        self.appended = len(pending)
+        logger.info('Compacted %s', self.path)
+
+    def close(self):
+        # a snapshot written after the next load replayed could overwrite a newer one
+        self._writer.shutdown()
+        if self._file:
+            self._file.close()
+            self._file = None
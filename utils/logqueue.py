@@ -0,0 +1,44 @@
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Hands records to a listener thread through a bounded queue.
+
+    When the queue is full the record is dropped and counted, the caller never
+    blocks. The next record that fits is preceded by a warning about the drops.
+    Records are queued unformatted, the listener's handlers merge the arguments.
+    """
+    def __init__(self, maxsize=10000):
+        super().__init__(queue.Queue(maxsize))
+        self.dropped = 0
+        self._reported = 0
+
+    def prepare(self, record):
+        # formatting is left to the listener thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            if self.dropped != self._reported:
+                self.queue.put_nowait(logging.makeLogRecord({
+                    'name': record.name, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                    'msg': 'Dropped %d log records, the log queue was full', 'args': (self.dropped - self._reported,),
+                }))
+                self._reported = self.dropped
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def start(logger, handlers, maxsize=10000):
+    """Route the records of `logger` through a queue to `handlers` on a background thread.
+
+    Returns the queue handler and the started listener.
+    """
+    handler = DroppingQueueHandler(maxsize)
+    listener = QueueListener(handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    logger.addHandler(handler)
+    return handler, listener
@@ -0,0 +1,158 @@
+import asyncio
+from collections import OrderedDict
+import logging
+import re
+import shutil
+import sqlite3
+import subprocess
+import threading
+
+# Logger
+logger = logging.getLogger('discord.bot').getChild(__name__)
+
+# Integrated loudness songs are brought to in LUFS
+TARGET = -16.0
+# Smaller corrections are not worth giving up remuxing Opus streams for
+MIN_GAIN = 1.0
+MAX_BOOST = 6.0
+MAX_CUT = -20.0
+# Quieter than this is silence, nothing to correct
+SILENCE = -60.0
+# Only the start of long tracks is measured
+MAX_SECONDS = 600
+TIMEOUT = 300.0
+# the summary at the end of ebur128's output
+INTEGRATED = re.compile(rb'I:\s+(-?[\d.]+) LUFS')
+# analysis yields the CPU to FFmpeg processes encoding voice
+NICE = ['nice', '-n', '10'] if shutil.which('nice') else []
+
+
+def gain_for(lufs):
+    """Return the gain in dB bringing `lufs` to the target, None if there is nothing to correct"""
+    if lufs is None or lufs < SILENCE:
+        return None
+    gain = min(MAX_BOOST, max(MAX_CUT, TARGET - lufs))
+    return gain if abs(gain) >= MIN_GAIN else None
+
+async def measure(url):
+    """Return the integrated loudness of a file or stream in LUFS, using FFmpeg's ebur128 filter"""
+    before = ['-reconnect', '1', '-reconnect_streamed', '1', '-reconnect_delay_max', '5'] if '://' in url else []
+    process = await asyncio.create_subprocess_exec(
+        *NICE, 'ffmpeg', '-nostdin', '-hide_banner', '-nostats', *before, '-t', str(MAX_SECONDS), '-i', url,
+        '-map', '0:a:0', '-threads', '1', '-af', 'ebur128', '-f', 'null', '-',
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    try:
+        _, stderr = await asyncio.wait_for(process.communicate(), TIMEOUT)
+    except BaseException:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+    values = INTEGRATED.findall(stderr)
+    if process.returncode or not values:
+        raise RuntimeError(f'ffmpeg exited with {process.returncode}')
+    return float(values[-1])
+
+
+class Loudness:
+    """Measures the loudness of tracks in the background and remembers their gain.
+
+    At most `workers` FFmpeg processes analyse at once. Results are kept by key
+    in memory, up to `maxsize`, and in an optional sqlite database. `gain()` only
+    looks at memory, so playback never waits for an analysis or the database.
+    """
+    def __init__(self, workers=1, path=None, max_pending=100, maxsize=10000):
+        self.max_pending = max_pending
+        self.maxsize = maxsize
+        self.analyzed = 0
+        self.failed = 0
+        self.skipped = 0
+        self._workers = asyncio.Semaphore(workers)
+
+        # key -> gain in dB or None
+        self._gains = OrderedDict()
+        self._tasks = {}
+
+        self._db = None
+        self._db_lock = threading.Lock()
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS loudness (key TEXT PRIMARY KEY, lufs REAL)')
+            self._db.commit()
+            logger.info('Using loudness database %s', path)
+
+    def stats(self):
+        return {
+            'known': len(self._gains),
+            'pending': len(self._tasks),
+            'analyzed': self.analyzed,
+            'failed': self.failed,
+            'skipped': self.skipped,
+        }
+
+    def close(self):
+        for task in self._tasks.values():
+            task.cancel()
+        if self._db:
+            with self._db_lock:
+                self._db.close()
+            self._db = None
+
+    def gain(self, key):
+        """Return the known gain of a track in dB, None if unknown or not worth applying"""
+        if key in self._gains:
+            self._gains.move_to_end(key)
+            return self._gains[key]
+        return None
+
+    def analyze(self, key, url):
+        """Measure a track in the background unless it is known already"""
+        if key in self._gains or key in self._tasks:
+            return
+        if len(self._tasks) >= self.max_pending:
+            self.skipped += 1
+            return
+        task = self._tasks[key] = asyncio.get_running_loop().create_task(self._analyze(key, url))
+        task.add_done_callback(lambda _: self._tasks.pop(key, None))
+
+    async def _analyze(self, key, url):
+        if self._db:
+            row = await asyncio.to_thread(self._db_get, key)
+            if row:
+                self._remember(key, gain_for(row[0]))
+                return
+
+        async with self._workers:
+            try:
+                lufs = await measure(url)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.failed += 1
+                logger.exception('Failed to measure the loudness of %s', key)
+                return
+        self.analyzed += 1
+        logger.info('Loudness of %s is %.1f LUFS', key, lufs)
+        self._remember(key, gain_for(lufs))
+        if self._db:
+            await asyncio.to_thread(self._db_put, key, lufs)
+
+    def _remember(self, key, gain):
+        self._gains[key] = gain
+        self._gains.move_to_end(key)
+        while len(self._gains) > self.maxsize:
+            self._gains.popitem(last=False)
+
+    # sqlite tier, run in a worker thread
+    def _db_get(self, key):
+        with self._db_lock:
+            if not self._db:
+                return None
+            return self._db.execute('SELECT lufs FROM loudness WHERE key = ?', (key,)).fetchone()
+
+    def _db_put(self, key, lufs):
+        with self._db_lock:
+            if not self._db:
+                return
+            self._db.execute('REPLACE INTO loudness VALUES (?, ?)', (key, lufs))
+            self._db.commit()
@@ -0,0 +1,193 @@
+import asyncio
+from bisect import bisect_left
+from contextlib import contextmanager
+import logging
+import math
+import time
+
+# Logger
+logger = logging.getLogger('discord.bot').getChild(__name__)
+
+# Default histogram buckets in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def format_value(value):
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def format_labels(names, values, extra=''):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        # label values tuple -> value
+        self.values = {}
+
+    def samples(self):
+        """Yield (suffix, label values, extra label, value)"""
+        for labels, value in self.values.items():
+            yield '', labels, '', value
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        for suffix, labels, extra, value in self.samples():
+            lines.append(f'{self.name}{suffix}{format_labels(self.labels, labels, extra)} {format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """A value which is set, or read from `func` when exposed.
+
+    `func` returns a number, or a dict of label values tuple -> number.
+    """
+    type = 'gauge'
+
+    def __init__(self, name, help, labels=(), func=None):
+        super().__init__(name, help, labels)
+        self.func = func
+
+    def set(self, value, labels=()):
+        self.values[labels] = value
+
+    def samples(self):
+        if self.func:
+            try:
+                value = self.func()
+            except Exception:
+                logger.exception('Failed to read gauge %s', self.name)
+                return
+            values = value if isinstance(value, dict) else {(): value}
+        else:
+            values = self.values
+        for labels, value in values.items():
+            yield '', labels, '', value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        # [count per bucket and +Inf, sum, count], counts are summed up when exposed
+        state = self.values.get(labels)
+        if state is None:
+            state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    @contextmanager
+    def time(self, labels=()):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, labels)
+
+    def samples(self):
+        for labels, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                yield '_bucket', labels, f'le="{format_value(float(bound))}"', cumulative
+            yield '_bucket', labels, 'le="+Inf"', count
+            yield '_sum', labels, '', total
+            yield '_count', labels, '', count
+
+
+class Registry:
+    """Metrics of the bot and its extensions.
+
+    Metrics are only touched from the event loop, so recording needs no locks.
+    Registering an existing name returns the existing metric, so reloaded
+    extensions keep their counts; gauges get the new `func`.
+    """
+    def __init__(self):
+        self.metrics = {}
+
+    def _register(self, cls, name, help, labels=(), **kwargs):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, help, labels, **kwargs)
+        elif not isinstance(metric, cls) or metric.labels != tuple(labels):
+            raise ValueError(f'Metric {name} is already registered differently')
+        elif 'func' in kwargs:
+            metric.func = kwargs['func']
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=(), func=None):
+        return self._register(Gauge, name, help, labels, func=func)
+
+    def histogram(self, name, help, labels=(), buckets=BUCKETS):
+        return self._register(Histogram, name, help, labels, buckets=buckets)
+
+    def unregister(self, name):
+        self.metrics.pop(name, None)
+
+    def expose(self):
+        """Return all metrics in the Prometheus text format"""
+        return '\n'.join(metric.expose() for metric in list(self.metrics.values())) + '\n'
+
+    async def serve(self, host, port):
+        """Serve the metrics over HTTP"""
+        server = await asyncio.start_server(self._handle, host, port)
+        logger.info('Serving metrics on %s:%s', host, port)
+        return server
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 10.0)
+            # skip the headers
+            while await asyncio.wait_for(reader.readline(), 10.0) not in (b'\r\n', b'\n', b''):
+                pass
+            method, path, *_ = request.decode('latin-1').split() or ['', '']
+            if method == 'GET' and path.split('?')[0] in ('/', '/metrics'):
+                status, body = '200 OK', self.expose().encode()
+            else:
+                status, body = '404 Not Found', b'Not Found\n'
+            writer.write(f'HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+async def monitor_loop(gauge, histogram, interval=1.0):
+    """Measure how late the event loop wakes up a sleeping task"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - started - interval)
+        gauge.set(lag)
+        histogram.observe(lag)
@@ -0,0 +1,221 @@
+import asyncio
+from collections import deque
+from contextlib import contextmanager
+import contextvars
+import itertools
+import logging
+import statistics
+import time
+
+# Logger
+logger = logging.getLogger('discord.bot').getChild(__name__)
+
+# Lower is sent first
+REPLY = 0
+CHECK_FAILURE = 1
+_priority = contextvars.ContextVar('outbox_priority', default=REPLY)
+# id of the message whose command the current task answers
+_origin = contextvars.ContextVar('outbox_origin', default=None)
+
+MESSAGE_LIMIT = 2000
+MESSAGES = ('POST', '/channels/{channel_id}/messages')
+REACTIONS = ('PUT', '/channels/{channel_id}/messages/{message_id}/reactions/{emoji}/@me')
+# Requests per seconds of Discord's per channel buckets
+LIMITS = {
+    MESSAGES: (5, 5.0),
+    REACTIONS: (1, 0.25),
+}
+# payload keys two messages may differ in and still be sent as one
+MERGEABLE = {'content', 'embed', 'allowed_mentions'}
+
+
+@contextmanager
+def priority(value):
+    """Send the messages and reactions of the current task with this priority"""
+    token = _priority.set(value)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+@contextmanager
+def origin(message_id):
+    """Mark the messages and reactions of the current task as answering this message"""
+    token = _origin.set(message_id)
+    try:
+        yield
+    finally:
+        _origin.reset(token)
+
+
+class Bucket:
+    """Sliding window of the requests sent on one rate limit bucket"""
+    def __init__(self, limit, per, clock):
+        self.limit = limit
+        self.per = per
+        self.clock = clock
+        self.sent = deque()
+
+    def delay(self):
+        """Seconds until the next request may be sent"""
+        now = self.clock()
+        while self.sent and self.sent[0] <= now - self.per:
+            self.sent.popleft()
+        if len(self.sent) < self.limit:
+            return 0.0
+        return self.sent[0] + self.per - now
+
+    def consume(self):
+        self.sent.append(self.clock())
+
+
+class Outbox:
+    """Queues messages and reactions per channel and paces them by Discord's rate limits.
+
+    Stands in for `http.request`, everything except creating messages and adding
+    reactions goes straight to `downstream`. When requests to a channel back up,
+    consecutive plain messages answering the same command (see `origin`) are sent
+    as one, reactions are dropped if a message answering the same command is
+    waiting or was sent while they waited and lower priority requests (see
+    `priority`) wait for the others. A request only waits for its own rate limit
+    bucket, one that is not held back is sent right away.
+    """
+    def __init__(self, downstream, limits=LIMITS, clock=time.monotonic):
+        self.downstream = downstream
+        # (method, path) -> (requests, per seconds) of the routes to queue
+        self.limits = limits
+        self.clock = clock
+        self._seq = itertools.count()
+        # channel id -> list of [priority, seq, route, kwargs, future, enqueued, origin]
+        self._queues = {}
+        self._buckets = {}
+
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped_reactions = 0
+        self.wait_times = deque(maxlen=500)
+
+    @property
+    def depth(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def stats(self):
+        stats = {
+            'pending': self.depth,
+            'channels': len(self._queues),
+            'sent': self.sent,
+            'coalesced': self.coalesced,
+            'dropped reactions': self.dropped_reactions,
+        }
+        if self.wait_times:
+            stats['wait p50 ms'] = round(statistics.median(self.wait_times) * 1000)
+            stats['wait max ms'] = round(max(self.wait_times) * 1000)
+        return stats
+
+    async def request(self, route, **kwargs):
+        kind = (route.method, route.path)
+        if kind not in self.limits or kwargs.get('form') or kwargs.get('files'):
+            return await self.downstream(route, **kwargs)
+
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.get(route.channel_id)
+        if queue is None:
+            queue = self._queues[route.channel_id] = []
+            asyncio.get_running_loop().create_task(self._drain(route.channel_id, queue))
+        queue.append([_priority.get(), next(self._seq), route, kwargs, future, self.clock(), _origin.get()])
+        return await future
+
+    def _bucket(self, route):
+        key = (route.method, route.bucket)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = Bucket(*self.limits[route.method, route.path], self.clock)
+        return bucket
+
+    async def _drain(self, channel_id, queue):
+        # origin -> when a message answering it was sent
+        answered = {}
+        try:
+            while queue:
+                delays = {}
+                for item in queue:
+                    bucket = self._bucket(item[2])
+                    if bucket not in delays:
+                        delays[bucket] = bucket.delay()
+                ready = [item for item in queue if delays[self._bucket(item[2])] <= 0]
+                if not ready:
+                    # more may be queued meanwhile, the next item is picked afterwards
+                    await asyncio.sleep(min(delays.values()))
+                    continue
+
+                # the first by priority among those whose own bucket allows sending
+                first = min(ready)
+                queue.remove(first)
+                if first[4].done():
+                    # the caller was cancelled
+                    continue
+                route, message_of = first[2], first[6]
+                items = [first]
+                if (route.method, route.path) == REACTIONS:
+                    if message_of is not None and (answered.get(message_of, float('-inf')) >= first[5] or any((item[2].method, item[2].path) == MESSAGES and item[6] == message_of for item in queue)):
+                        # a message answers the command already
+                        logger.debug('Dropped reaction in channel %s', channel_id)
+                        self.dropped_reactions += 1
+                        first[4].set_result(None)
+                        continue
+                    kwargs = first[3]
+                else:
+                    kwargs = self._merge(items, queue)
+                    if message_of is not None:
+                        answered[message_of] = self.clock()
+
+                self._bucket(route).consume()
+                now = self.clock()
+                for item in items:
+                    self.wait_times.append(now - item[5])
+                self.sent += 1
+                try:
+                    result = await self.downstream(route, **kwargs)
+                except Exception as e:
+                    for item in items:
+                        if not item[4].done():
+                            item[4].set_exception(e)
+                else:
+                    for item in items:
+                        if not item[4].done():
+                            item[4].set_result(result)
+        finally:
+            if self._queues.get(channel_id) is queue:
+                del self._queues[channel_id]
+            for item in queue:
+                item[4].cancel()
+
+    def _merge(self, items, queue):
+        """Take the messages answering the same command after items[0] that can be sent along with it"""
+        payload = dict(items[0][3].get('json') or {})
+        level, message_of = items[0][0], items[0][6]
+        following = sorted(item for item in queue if item[6] == message_of and item[0] == level and (item[2].method, item[2].path) == MESSAGES and not item[4].done())
+        for item in following:
+            if not mergeable(payload, item):
+                break
+            other = item[3]['json']
+            content = '\n'.join(filter(None, (payload.get('content'), other.get('content'))))
+            # an embed is shown below the content, so it has to come last
+            if len(content) > MESSAGE_LIMIT or payload.get('embed'):
+                break
+            queue.remove(item)
+            items.append(item)
+            if content:
+                payload['content'] = content
+            if other.get('embed'):
+                payload['embed'] = other['embed']
+            self.coalesced += 1
+        return dict(items[0][3], json=payload)
+
+
+def mergeable(payload, item):
+    route, kwargs = item[2], item[3]
+    if (route.method, route.path) != MESSAGES or set(kwargs) != {'json'}:
+        return False
+    other = kwargs['json']
+    return set(payload) <= MERGEABLE and set(other) <= MERGEABLE and payload.get('allowed_mentions') == other.get('allowed_mentions')
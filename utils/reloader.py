@@ -0,0 +1,198 @@
+import asyncio
+import hashlib
+import importlib
+import logging
+import os
+import sys
+
+from discord.ext import commands
+
+# Logger
+logger = logging.getLogger('discord.bot').getChild(__name__)
+
+
+def source_hash(path):
+    with open(path, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+class Reloader:
+    """Reloads the extensions whose source, or the source of a module they use, changed.
+
+    Only modules below `root` are tracked. Changed helper modules are imported
+    afresh together with every module using them, then the affected extensions
+    are reloaded. Helper modules the bot itself uses outside of extensions are
+    kept, extensions would otherwise see different state, e.g. context variables,
+    than the bot. Changes to them need a restart. Syntax errors are caught before anything is touched and if any
+    import or setup fails, every extension already reloaded in the batch is
+    rolled back, so the bot never runs a half reloaded set.
+    """
+    def __init__(self, bot, root):
+        self.bot = bot
+        self.root = os.path.join(os.path.abspath(root), '')
+        # module name -> source hash of the loaded version
+        self.hashes = {}
+        self._mtimes = {}
+
+    def local_modules(self):
+        """Return module name -> file of the loaded project modules"""
+        modules = {}
+        for name, module in list(sys.modules.items()):
+            path = getattr(module, '__file__', None)
+            if path and path.startswith(self.root) and path.endswith('.py'):
+                modules[name] = path
+        return modules
+
+    def dependencies(self, modules):
+        """Return module name -> project modules it references"""
+        graph = {}
+        for name in modules:
+            uses = set()
+            for value in vars(sys.modules[name]).values():
+                used = value.__name__ if isinstance(value, type(sys)) else getattr(value, '__module__', None)
+                if isinstance(used, str) and used != name and used in modules:
+                    uses.add(used)
+            graph[name] = uses
+        return graph
+
+    def tracked(self):
+        """Return module name -> file of the extensions and the project modules they use"""
+        modules = self.local_modules()
+        graph = self.dependencies(modules)
+        tracked = set()
+        pending = [name for name in modules if any(name == extension or name.startswith(extension + '.') for extension in self.bot.extensions)]
+        while pending:
+            name = pending.pop()
+            if name not in tracked:
+                tracked.add(name)
+                pending.extend(graph[name])
+        return {name: modules[name] for name in tracked}
+
+    def pinned(self):
+        """Return the project modules used by project modules outside of extensions, e.g. `__main__`"""
+        modules = self.local_modules()
+        graph = self.dependencies(modules)
+        tracked = self.tracked()
+        pinned = set()
+        # a package refers to its submodules without using them
+        pending = [used for name, uses in graph.items() if name not in tracked for used in uses if not used.startswith(name + '.')]
+        while pending:
+            name = pending.pop()
+            if name not in pinned:
+                pinned.add(name)
+                pending.extend(graph[name])
+        return pinned
+
+    def snapshot(self, names=None):
+        """Remember the source of `names`, or of modules seen for the first time"""
+        for name, path in self.tracked().items():
+            if name not in self.hashes or (names is not None and name in names):
+                self.hashes[name] = source_hash(path)
+
+    def changed(self):
+        modules = self.tracked()
+        return {name for name, path in modules.items() if name in self.hashes and source_hash(path) != self.hashes[name]}
+
+    def plan(self, changed):
+        """Return the helper modules to import afresh and the extensions to reload"""
+        modules = self.tracked()
+        graph = self.dependencies(modules)
+        pinned = self.pinned()
+        if changed & pinned:
+            logger.warning('Not reloading %s, used by the bot itself. Restart to apply changes', ', '.join(sorted(changed & pinned)))
+        affected = set(changed) - pinned
+        # everything using an affected module holds references to the old version
+        while True:
+            dependents = {name for name, uses in graph.items() if uses & affected} - affected - pinned
+            if not dependents:
+                break
+            affected |= dependents
+        extensions = [name for name in self.bot.extensions if name in affected]
+        helpers = [name for name in affected if name not in self.bot.extensions and not any(name.startswith(extension + '.') for extension in extensions)]
+        return helpers, extensions
+
+    def reload(self, names=None):
+        """Reload the changed extensions, or `names` and everything using them.
+
+        Returns the reloaded extensions, raises after rolling back on failure.
+        """
+        if names is None:
+            changed = self.changed()
+        else:
+            for name in names:
+                if name not in self.bot.extensions:
+                    raise commands.ExtensionNotLoaded(name)
+            changed = set(names)
+        if not changed:
+            return []
+        helpers, extensions = self.plan(changed)
+        modules = self.tracked()
+
+        # a syntax error in any file fails the batch before anything is unloaded
+        for name in changed:
+            with open(modules[name], 'rb') as file:
+                compile(file.read(), modules[name], 'exec')
+
+        saved = {name: sys.modules[name] for name in helpers}
+        reloaded = []
+        try:
+            for name in helpers:
+                del sys.modules[name]
+            for name in sorted(helpers):
+                if name not in sys.modules:
+                    importlib.import_module(name)
+            for extension in extensions:
+                old = self.bot.extensions[extension]
+                old_modules = {name: module for name, module in sys.modules.items() if name == extension or name.startswith(extension + '.')}
+                # restores the old version of this one extension by itself on failure
+                self.bot.reload_extension(extension)
+                reloaded.append((extension, old, old_modules))
+        except Exception:
+            logger.warning('Reloading %s failed, rolling back', ', '.join(extensions))
+            self.rollback(reloaded, saved)
+            raise
+
+        self.snapshot(modules)
+        logger.info('Reloaded %s', ', '.join(extensions) or 'nothing')
+        return extensions
+
+    def rollback(self, reloaded, saved):
+        sys.modules.update(saved)
+        for extension, old, old_modules in reversed(reloaded):
+            try:
+                self.bot.unload_extension(extension)
+            except Exception:
+                logger.exception('Failed to unload new version of %s', extension)
+            # the same steps reload_extension takes to restore an extension
+            sys.modules.update(old_modules)
+            old.setup(self.bot)
+            self.bot._BotBase__extensions[extension] = old
+
+    async def watch(self, interval=1.0, debounce=0.5):
+        """Reload whenever project files change, once they stopped changing for `debounce` seconds"""
+        while True:
+            await asyncio.sleep(interval)
+            if not self._modified():
+                continue
+            # editors and checkouts write several files in a row
+            while True:
+                await asyncio.sleep(debounce)
+                if not self._modified():
+                    break
+            try:
+                self.reload()
+            except Exception:
+                # the old versions keep running
+                logger.exception('Failed to reload changed extensions')
+
+    def _modified(self):
+        modified = False
+        for name, path in self.tracked().items():
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+            if self._mtimes.setdefault(name, mtime) != mtime:
+                self._mtimes[name] = mtime
+                modified = True
+        return modified
@@ -0,0 +1,129 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+# Logger
+logger = logging.getLogger('discord.bot').getChild(__name__)
+
+
+class Scheduler:
+    """Keyed deadlines on a heap, driven by a single timer on the event loop.
+
+    Keys are tuples starting with a namespace, e.g. `('music.idle', guild_id)`.
+    Scheduling a key again replaces its deadline. Pushing a deadline back, which is
+    what an idle timer does on every command, only updates the entry; the heap item
+    is moved when it comes up. Cancelled entries are dropped lazily as well.
+
+    `clock` must be monotonic. With a fake clock, call `run_due()` after advancing it.
+    """
+    def __init__(self, loop=None, clock=time.monotonic):
+        self.loop = loop
+        self.clock = clock
+        # [deadline, seq, key], possibly stale or earlier than the entry's deadline
+        self._heap = []
+        # key -> [deadline, seq of its heap item, deadline of its heap item, callback, args]
+        self._entries = {}
+        self._seq = itertools.count()
+        self._handle = None
+        self._armed_for = None
+        self.fired = 0
+        self.failed = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def stats(self):
+        return {'scheduled': len(self._entries), 'heap': len(self._heap), 'fired': self.fired, 'failed': self.failed}
+
+    def deadline(self, key):
+        """Return the clock time the key fires at, or None"""
+        entry = self._entries.get(key)
+        return entry[0] if entry else None
+
+    def schedule(self, key, delay, callback, *args):
+        """Call `callback(*args)` in `delay` seconds, replacing the key's previous deadline.
+
+        Coroutines returned by the callback are run as tasks.
+        """
+        deadline = self.clock() + delay
+        entry = self._entries.get(key)
+        if entry and entry[2] <= deadline:
+            entry[0], entry[3], entry[4] = deadline, callback, args
+            return
+
+        seq = next(self._seq)
+        self._entries[key] = [deadline, seq, deadline, callback, args]
+        heapq.heappush(self._heap, [deadline, seq, key])
+        self._compact()
+        self._arm()
+
+    def cancel(self, key):
+        """Forget a deadline. Returns whether it was scheduled"""
+        return self._entries.pop(key, None) is not None
+
+    def cancel_namespace(self, namespace):
+        """Forget all deadlines of a namespace, e.g. when a cog is unloaded"""
+        for key in [key for key in self._entries if key[0] == namespace]:
+            del self._entries[key]
+
+    def close(self):
+        self._entries.clear()
+        self._heap.clear()
+        if self._handle:
+            self._handle.cancel()
+            self._handle = None
+
+    def run_due(self):
+        """Fire all deadlines which have passed"""
+        self._handle = None
+        self._armed_for = None
+        now = self.clock()
+        while self._heap and self._heap[0][0] <= now:
+            _, seq, key = heapq.heappop(self._heap)
+            entry = self._entries.get(key)
+            if entry is None or entry[1] != seq:
+                continue
+            if entry[0] > now:
+                # pushed back since it was queued
+                entry[1], entry[2] = next(self._seq), entry[0]
+                heapq.heappush(self._heap, [entry[0], entry[1], key])
+                continue
+
+            del self._entries[key]
+            self.fired += 1
+            try:
+                result = entry[3](*entry[4])
+                if asyncio.iscoroutine(result):
+                    self._get_loop().create_task(result)
+            except Exception:
+                self.failed += 1
+                logger.exception('Scheduled callback for %s failed', key)
+        self._arm()
+
+    def _compact(self):
+        # cancelled and rescheduled entries leave stale heap items behind
+        if len(self._heap) > 64 and len(self._heap) > 2 * len(self._entries):
+            self._heap = [item for item in self._heap if (entry := self._entries.get(item[2])) and entry[1] == item[1]]
+            heapq.heapify(self._heap)
+
+    def _get_loop(self):
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+        return self.loop
+
+    def _arm(self):
+        if not self._heap:
+            return
+        when = self._heap[0][0]
+        # an earlier wakeup just re-arms for the next deadline
+        if self._handle and self._armed_for <= when:
+            return
+        if self._handle:
+            self._handle.cancel()
+        self._armed_for = when
+        self._handle = self._get_loop().call_later(max(0.0, when - self.clock()), self.run_due)
@@ -0,0 +1,181 @@
+import asyncio
+from collections import OrderedDict
+import json
+import logging
+import sqlite3
+import threading
+
+# Logger
+logger = logging.getLogger('discord.bot').getChild(__name__)
+
+
+def at_least(minimum, type=float):
+    """Return a converter for numbers of at least `minimum`"""
+    def convert(text):
+        value = type(text)
+        if value < minimum:
+            raise ValueError(f'must be at least {minimum}')
+        return value
+    return convert
+
+
+class Field:
+    __slots__ = ('convert', 'default', 'help', 'pinned')
+
+    def __init__(self, convert, default, help, pinned):
+        self.convert = convert
+        self.default = default
+        self.help = help
+        self.pinned = pinned
+
+
+class Settings:
+    """Per guild settings in sqlite behind a bounded in-memory cache.
+
+    Settings are registered with a default, guilds only store what they changed.
+    Writes go to the database and the cache together. The overrides of pinned
+    settings, e.g. the prefix looked up for every message, are all held in memory
+    and never evicted, so reading them never touches the database. Other settings
+    of up to `maxsize` guilds are cached, a miss reads the guild's rows at once in
+    a worker thread.
+    """
+    def __init__(self, path=None, maxsize=1024):
+        self.maxsize = maxsize
+        self.fields = {}
+        self.hits = 0
+        self.misses = 0
+
+        # guild id -> {name: value} of the guild's overrides
+        self._guilds = OrderedDict()
+        # name -> {guild id: value} of pinned settings
+        self._pinned = {}
+        # guild id -> task reading the guild's overrides
+        self._loading = {}
+        # guilds written while being read
+        self._stale = set()
+
+        # without a path settings last until the bot stops
+        self._db_lock = threading.Lock()
+        self._db = sqlite3.connect(path or ':memory:', check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS settings (guild_id INTEGER, name TEXT, value TEXT, PRIMARY KEY (guild_id, name))')
+        self._db.commit()
+        if path:
+            logger.info('Using settings database %s', path)
+
+    def stats(self):
+        return {
+            'guilds': len(self._guilds),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+    def close(self):
+        with self._db_lock:
+            self._db.close()
+
+    def register(self, name, convert, default, help, pinned=False):
+        """Add a setting, `convert(text)` parses values given in commands and raises ValueError"""
+        self.fields[name] = Field(convert, default, help, pinned)
+        if pinned:
+            self._load_pinned(name)
+
+    def unregister(self, name):
+        self.fields.pop(name, None)
+        self._pinned.pop(name, None)
+
+    def pinned(self, name):
+        """Return the guild id -> value dict of a pinned setting, it is updated in place"""
+        return self._pinned[name]
+
+    async def get(self, guild_id, name):
+        """Return a guild's value of a setting"""
+        field = self.fields[name]
+        if field.pinned:
+            return self._pinned[name].get(guild_id, field.default)
+        return (await self._overrides(guild_id)).get(name, field.default)
+
+    async def overridden(self, guild_id):
+        """Return the settings a guild changed"""
+        overrides = dict(await self._overrides(guild_id))
+        for name, values in self._pinned.items():
+            if guild_id in values:
+                overrides[name] = values[guild_id]
+        return overrides
+
+    async def set(self, guild_id, name, value):
+        field = self.fields[name]
+        await asyncio.to_thread(self._db_write, 'REPLACE INTO settings VALUES (?, ?, ?)', (guild_id, name, json.dumps(value)))
+        if field.pinned:
+            self._pinned[name][guild_id] = value
+        elif guild_id in self._guilds:
+            self._guilds[guild_id][name] = value
+        elif guild_id in self._loading:
+            self._stale.add(guild_id)
+
+    async def reset(self, guild_id, name):
+        """Go back to the default"""
+        await asyncio.to_thread(self._db_write, 'DELETE FROM settings WHERE guild_id = ? AND name = ?', (guild_id, name))
+        self._pinned.get(name, {}).pop(guild_id, None)
+        if guild_id in self._guilds:
+            self._guilds[guild_id].pop(name, None)
+        elif guild_id in self._loading:
+            self._stale.add(guild_id)
+
+    def invalidate(self, guild_id=None):
+        """Drop cached settings of a guild, or of all guilds, e.g. after editing the database"""
+        if guild_id is None:
+            self._guilds.clear()
+            self._stale.update(self._loading)
+            for name in self._pinned:
+                self._load_pinned(name)
+        else:
+            self._guilds.pop(guild_id, None)
+            if guild_id in self._loading:
+                self._stale.add(guild_id)
+
+    def _load_pinned(self, name):
+        # filled in place, callers may hold on to the dict
+        overrides = self._pinned.setdefault(name, {})
+        with self._db_lock:
+            rows = self._db.execute('SELECT guild_id, value FROM settings WHERE name = ?', (name,)).fetchall()
+        overrides.clear()
+        for guild_id, value in rows:
+            overrides[guild_id] = json.loads(value)
+
+    async def _overrides(self, guild_id):
+        overrides = self._guilds.get(guild_id)
+        if overrides is not None:
+            self.hits += 1
+            self._guilds.move_to_end(guild_id)
+            return overrides
+
+        # concurrent misses of a guild share one read
+        self.misses += 1
+        task = self._loading.get(guild_id)
+        if task is None:
+            task = self._loading[guild_id] = asyncio.ensure_future(self._load(guild_id))
+            task.add_done_callback(lambda _: self._loading.pop(guild_id, None))
+        return await asyncio.shield(task)
+
+    async def _load(self, guild_id):
+        while True:
+            self._stale.discard(guild_id)
+            rows = await asyncio.to_thread(self._db_read, guild_id)
+            # read again if a write may have raced the read
+            if guild_id not in self._stale:
+                break
+        overrides = self._guilds[guild_id] = {name: json.loads(value) for name, value in rows if name not in self._pinned}
+        while len(self._guilds) > self.maxsize:
+            self._guilds.popitem(last=False)
+        return overrides
+
+    # run in a worker thread
+    def _db_read(self, guild_id):
+        # a guild's rows are few and indexed by the primary key
+        with self._db_lock:
+            return self._db.execute('SELECT name, value FROM settings WHERE guild_id = ?', (guild_id,)).fetchall()
+
+    def _db_write(self, query, parameters):
+        with self._db_lock:
+            self._db.execute(query, parameters)
+            self._db.commit()
@@ -0,0 +1,117 @@
+import asyncio
+from collections import Counter
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+# Logger
+logger = logging.getLogger('discord.bot').getChild(__name__)
+
+
+class Watchdog:
+    """Detects callbacks blocking the event loop.
+
+    A task on the loop records a heartbeat every `interval` seconds and a thread
+    checks it. When the heartbeat is more than `threshold` seconds old the stack of
+    the loop thread, which is what is blocking it, is logged once per stall.
+    While the loop is healthy the thread calls `notify` every `notify_interval`
+    seconds, e.g. to feed the systemd watchdog.
+    """
+    def __init__(self, threshold=1.0, interval=0.1, notify=None, notify_interval=None):
+        self.threshold = threshold
+        self.interval = interval
+        self.notify = notify
+        self.notify_interval = notify_interval
+        self.stalls = 0
+        self.longest = 0.0
+        self.last_stack = None
+        self._beat = time.monotonic()
+        self._loop_thread = None
+        self._task = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def lag(self):
+        return max(0.0, time.monotonic() - self._beat - self.interval)
+
+    @property
+    def healthy(self):
+        return self.lag < self.threshold
+
+    def start(self):
+        """Start the heartbeat on the running loop and the watching thread"""
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._task = asyncio.get_running_loop().create_task(self._heartbeat())
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._watch, name='watchdog', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+
+    async def _heartbeat(self):
+        while True:
+            self._beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+
+    def _watch(self):
+        stalled = False
+        worst = 0.0
+        notified = 0.0
+        while not self._stop.wait(self.interval):
+            lag = self.lag
+            if lag >= self.threshold:
+                worst = max(worst, lag)
+                self.longest = max(self.longest, lag)
+                if not stalled:
+                    stalled = True
+                    self.stalls += 1
+                    frame = sys._current_frames().get(self._loop_thread)
+                    self.last_stack = ''.join(traceback.format_stack(frame)) if frame else None
+                    logger.warning('Event loop blocked for %.3f seconds in:\n%s', lag, self.last_stack)
+            else:
+                if stalled:
+                    logger.warning('Event loop recovered after %.3f seconds', worst)
+                stalled = False
+                worst = 0.0
+                if self.notify and time.monotonic() - notified >= self.notify_interval:
+                    notified = time.monotonic()
+                    try:
+                        self.notify()
+                    except Exception:
+                        logger.exception('Failed to notify watchdog')
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+def sample(seconds, interval=0.005):
+    """Sample the stacks of all other threads and return them in the collapsed stack format.
+
+    Each line is `thread;outermost;...;innermost count`, which flamegraph.pl and
+    speedscope read. Blocks the calling thread, so run it in an executor.
+    """
+    me = threading.get_ident()
+    stacks = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)).replace(';', ':'))
+            stacks[';'.join(reversed(stack))] += 1
+        time.sleep(interval)
+    return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())